@@ -0,0 +1,291 @@
+'''
+Offline batch mode for bulk evaluation. Every puzzle runs its usual pipeline in a thread, but each chat completion
+    is queued instead of sent. Once every pipeline is waiting, the queued requests of all puzzles are written to a
+    JSONL batch file and submitted through a batch backend, and the pipelines resume as the results come back
+'''
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+from openai import OpenAI
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+
+
+def log(message):
+    # progress goes to the real stdout, the pipelines' prints may be silenced
+    print(message, file=sys.__stdout__, flush=True)
+
+
+def to_response(body: dict):
+    '''
+    Returns a chat completion body as an object with attribute access (response.choices[0].message.content)
+    '''
+    return json.loads(json.dumps(body), object_hook=lambda d: SimpleNamespace(**d))
+
+
+def read_batch_output(output_path: str):
+    '''
+    Returns a dict with key: custom_id and val: response body, or an error message for failed requests
+    '''
+    results = {}
+    with open(output_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response')
+            if response and response.get('status_code') == 200:
+                results[result['custom_id']] = response['body']
+            else:
+                error = result.get('error') or (response or {}).get('body')
+                results[result['custom_id']] = RuntimeError(f"Batch request failed: {error}")
+    return results
+
+
+class LocalBatchBackend:
+    '''
+    Local stand-in for a provider batch interface. Processes a batch file with concurrent live requests and
+        writes an output file in the provider format
+    '''
+    def __init__(self, client=None, max_workers=16):
+        self.client = client or OpenAI()
+        self.max_workers = max_workers
+
+    def process(self, request):
+        try:
+            response = self.client.chat.completions.create(**request['body'])
+            return {"custom_id": request['custom_id'], "response": {"status_code": 200, "body": response.model_dump()}, "error": None}
+        except Exception as e:
+            return {"custom_id": request['custom_id'], "response": None, "error": {"message": repr(e)}}
+
+    def run(self, input_path: str, output_path: str):
+        with open(input_path) as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor, open(output_path, 'w') as output_file:
+            for future in as_completed([executor.submit(self.process, request) for request in requests]):
+                output_file.write(json.dumps(future.result()) + '\n')
+        return read_batch_output(output_path)
+
+
+class OpenAIBatchBackend:
+    '''
+    Submits a batch file through the OpenAI Batch API and polls until it is done
+    '''
+    def __init__(self, client=None, poll_seconds=30, completion_window='24h'):
+        self.client = client or OpenAI()
+        self.poll_seconds = poll_seconds
+        self.completion_window = completion_window
+
+    def run(self, input_path: str, output_path: str):
+        with open(input_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                           completion_window=self.completion_window)
+        log(f"Submitted batch {batch.id}")
+        while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+            time.sleep(self.poll_seconds)
+            batch = self.client.batches.retrieve(batch.id)
+        if not batch.output_file_id and not batch.error_file_id:
+            raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+
+        with open(output_path, 'w') as output_file:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    output_file.write(self.client.files.content(file_id).text)
+        return read_batch_output(output_path)
+
+
+class BatchClient:
+    '''
+    Drop in for the OpenAI client (client.chat.completions.create) that queues requests into batches.
+        A request's custom_id is the hash of its body and the number of identical requests before it, so a rerun
+        asks for the same ids and every response already in the cache file is returned without a new batch
+    '''
+    def __init__(self, backend, cache_path='batch_responses.jsonl', batch_dir='batches', idle_seconds=1.0, max_batch_size=50000):
+        self.backend = backend
+        self.cache_path = cache_path
+        self.batch_dir = batch_dir
+        self.idle_seconds = idle_seconds # a batch is sent once no request was queued for this long
+        self.max_batch_size = max_batch_size
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+        self.lock = threading.Lock()
+        self.responses = self.load_cache() # key: custom_id, val: response body
+        self.occurrences = defaultdict(int) # key: request hash, val: number of times it was asked
+        self.pending = {} # key: custom_id, val: (request body, Future)
+        self.last_request = time.monotonic()
+        self.num_batches = 0
+        self.num_cached = 0
+        self.closed = threading.Event()
+        os.makedirs(batch_dir, exist_ok=True)
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def load_cache(self):
+        responses = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError: # last line of a run that was killed mid write
+                        continue
+                    responses[entry['custom_id']] = entry['body']
+        return responses
+
+    def create(self, model, messages, **kwargs):
+        if kwargs.get('stream'):
+            raise ValueError("Streaming is not supported in batch mode")
+        body = {"model": model, "messages": list(messages), **kwargs}
+        request_hash = hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()[:24]
+        with self.lock:
+            custom_id = f"{request_hash}-{self.occurrences[request_hash]}"
+            self.occurrences[request_hash] += 1
+            if custom_id in self.responses:
+                self.num_cached += 1
+                return to_response(self.responses[custom_id])
+            future = Future()
+            self.pending[custom_id] = (body, future)
+            self.last_request = time.monotonic()
+        return to_response(future.result())
+
+    def flush_loop(self):
+        while not self.closed.is_set():
+            time.sleep(0.1)
+            with self.lock:
+                is_idle = time.monotonic() - self.last_request >= self.idle_seconds
+                if not self.pending or (not is_idle and len(self.pending) < self.max_batch_size):
+                    continue
+                pending, self.pending = self.pending, {}
+            self.flush(pending)
+
+    def flush(self, pending):
+        '''
+        Sends the pending requests as one batch and resolves their futures. Any failure is set on the futures
+            that are not resolved yet, so no pipeline waits forever on a lost batch
+        '''
+        try:
+            self.send(pending)
+        except Exception as e:
+            log(f"Batch {self.num_batches} failed: {e!r}")
+            for _, future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+
+    def send(self, pending):
+        self.num_batches += 1
+        input_path = os.path.join(self.batch_dir, f"batch_{int(time.time())}_{self.num_batches}.jsonl")
+        output_path = input_path.replace('.jsonl', '_output.jsonl')
+        with open(input_path, 'w') as f:
+            for custom_id, (body, _) in pending.items():
+                f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}) + '\n')
+        log(f"Sending batch {self.num_batches} with {len(pending)} requests")
+
+        try:
+            results = self.backend.run(input_path, output_path)
+        except Exception as e:
+            results = {}
+            error = e
+        else:
+            error = RuntimeError("Request missing from the batch output")
+
+        with open(self.cache_path, 'a') as cache_file:
+            for custom_id, (body, future) in pending.items():
+                result = results.get(custom_id, error)
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                    continue
+                cache_file.write(json.dumps({"custom_id": custom_id, "body": result}) + '\n')
+                with self.lock:
+                    self.responses[custom_id] = result
+                future.set_result(result)
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+
+
+def run(dataset_path: str, results_path: str, backend, cache_path='batch_responses.jsonl', batch_dir='batches',
+        max_in_flight=200, idle_seconds=1.0, verbose=False):
+    '''
+    Solves every puzzle of the dataset without a result, max_in_flight puzzles at a time, with all their requests
+        sent in batches. Results are appended to results_path like evaluate.py, with the calls, tokens and limit_hit
+        of each puzzle from its budget. The profiler and the router are shared by the threads, so per stage timings
+        and escalations are only logged for the whole run
+    '''
+    from model import set_client
+    from main import Engine
+    from wordplay import WordplayDetector
+    from evaluate import AnswerKey, load_puzzles, load_finished, ret_board_words
+    from budget import Budget
+    from tokens import profiler
+    from cascade import router
+
+    client = BatchClient(backend, cache_path, batch_dir, idle_seconds)
+    set_client(client)
+    wordplay_detector = WordplayDetector()
+    results_lock = threading.Lock()
+    counts = {"solved": 0, "failed": 0, "error": 0}
+
+    def solve(puzzle):
+        words = ret_board_words(puzzle)
+        oracle = AnswerKey(puzzle['answers'])
+        start = time.perf_counter()
+        result = {"puzzle_id": puzzle['puzzle_id']}
+        budget = Budget() # counts the calls and tokens of this puzzle only
+        try:
+            # streaming and speculation need live requests, the solutions are ranked at once so each ranking step is one batch
+            engine = Engine(words, oracle=oracle, wordplay_detector=wordplay_detector, budget=budget, concurrent_ranking=True)
+            engine.main()
+            result.update({
+                "outcome": "solved" if engine.groups_correct == 4 else "failed",
+                "groups_correct": engine.groups_correct,
+                "num_mistakes": engine.num_mistakes,
+            })
+        except Exception as e:
+            result.update({"outcome": "error", "error": repr(e)})
+        result["seconds"] = time.perf_counter() - start
+        result["submissions"] = oracle.submissions
+        result.update({"calls": budget.num_calls, "tokens": budget.num_tokens, "limit_hit": budget.limit_hit})
+
+        with results_lock, open(results_path, 'a') as results_file:
+            results_file.write(json.dumps(result) + '\n')
+            counts[result['outcome']] += 1
+        log(f"{result['puzzle_id']}: {result['outcome']}, {result.get('num_mistakes')} mistakes")
+
+    finished = load_finished(results_path)
+    puzzles = [puzzle for puzzle in load_puzzles(dataset_path) if puzzle['puzzle_id'] not in finished]
+    log(f"Solving {len(puzzles)} puzzles in batch mode, {len(finished)} already have a result")
+    with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w')):
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            list(executor.map(solve, puzzles))
+
+    client.close()
+    log(f"Prompt tokens by stage:\n{profiler.report()}")
+    log(f"Model cascade:\n{router.report()}")
+    log(f"Finished: {counts}, {client.num_batches} batches sent, {client.num_cached} responses taken from the cache")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the solver on a JSONL dataset with batched requests")
+    parser.add_argument('dataset')
+    parser.add_argument('results')
+    parser.add_argument('--backend', choices=['openai', 'local'], default='openai')
+    parser.add_argument('--cache', default='batch_responses.jsonl')
+    parser.add_argument('--batch-dir', default='batches')
+    parser.add_argument('--max-in-flight', type=int, default=200)
+    parser.add_argument('--idle-seconds', type=float, default=1.0)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    backend = OpenAIBatchBackend() if args.backend == 'openai' else LocalBatchBackend()
+    run(args.dataset, args.results, backend, args.cache, args.batch_dir, args.max_in_flight, args.idle_seconds, args.verbose)
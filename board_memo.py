@@ -0,0 +1,70 @@
+'''
+Memo of solved boards, so a board that was played before is replayed without running the solver
+'''
+import sqlite3
+import hashlib
+import json
+import threading
+
+
+class BoardMemo:
+    '''
+    SQLite memo keyed on the canonical board. For every game state (board, failed groups, solved groups) it stores
+        the final ranked group order of the solver, and for every board the confirmed outcome of each submitted group
+    '''
+    def __init__(self, path='board_memo.db'):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS rankings (state_key TEXT PRIMARY KEY, ranked_groups TEXT)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS outcomes ("
+                "board_key TEXT, group_key TEXT, words TEXT, correct INTEGER, "
+                "PRIMARY KEY (board_key, group_key)) WITHOUT ROWID")
+
+    def canonical_groups(self, groups):
+        return sorted(sorted(group) for group in groups)
+
+    def board_key(self, all_words: list[str]):
+        return hashlib.sha256(json.dumps(sorted(all_words)).encode()).hexdigest()
+
+    def state_key(self, all_words: list[str], failed_groups: list, solved_groups: list):
+        state = [sorted(all_words), self.canonical_groups(failed_groups), self.canonical_groups(solved_groups)]
+        return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
+    def record_ranking(self, state_key: str, ranked_groups: list):
+        '''
+        Stores the ranked groups of the solver for a game state, replacing an older ranking
+        '''
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO rankings (state_key, ranked_groups) VALUES (?, ?)",
+                                    (state_key, json.dumps(ranked_groups)))
+
+    def lookup_ranking(self, state_key: str):
+        '''
+        Returns the ranked groups stored for a game state or None
+        '''
+        with self.lock:
+            row = self.connection.execute("SELECT ranked_groups FROM rankings WHERE state_key = ?", (state_key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def record_outcome(self, all_words: list[str], group_words: list[str], correct: bool):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO outcomes (board_key, group_key, words, correct) VALUES (?, ?, ?, ?)",
+                (self.board_key(all_words), '#'.join(sorted(group_words)), json.dumps(sorted(group_words)), int(correct)))
+
+    def lookup_outcomes(self, all_words: list[str]):
+        '''
+        Returns (list of group words confirmed correct, list of group words confirmed wrong) on the board
+        '''
+        with self.lock:
+            rows = self.connection.execute("SELECT words, correct FROM outcomes WHERE board_key = ?",
+                                           (self.board_key(all_words),)).fetchall()
+        correct_groups = [json.loads(words) for words, correct in rows if correct]
+        wrong_groups = [json.loads(words) for words, correct in rows if not correct]
+        return correct_groups, wrong_groups
+
+    def close(self):
+        self.connection.close()
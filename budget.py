@@ -0,0 +1,85 @@
+'''
+Per puzzle budget of LLM calls, tokens and time
+'''
+import threading
+import time
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, limit: str):
+        super().__init__(f"Puzzle budget exceeded: {limit}")
+        self.limit = limit
+
+
+class Budget:
+    '''
+    Tracks the calls, tokens and seconds spent on one puzzle against its limits (None is unlimited). Every request
+        is charged before it is sent and raises BudgetExceeded once a limit is hit. The stages shrink as the budget
+        runs low: one agent less past degrade_at of a limit, a single debate round past single_round_at, and once a
+        limit is hit the best groups so far are submitted without another call
+    '''
+    def __init__(self, max_calls=None, max_tokens=None, max_seconds=None, degrade_at=0.5, single_round_at=0.75):
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.degrade_at = degrade_at
+        self.single_round_at = single_round_at
+        self.lock = threading.Lock()
+        self.num_calls = 0
+        self.num_tokens = 0 # prompt and completion tokens
+        self.start = time.monotonic()
+        self.limit_hit = None # name of the first limit that was hit
+
+    def seconds(self):
+        return time.monotonic() - self.start
+
+    def used_fraction(self):
+        '''
+        Returns the largest used share of any limit
+        '''
+        used = [0.0]
+        if self.max_calls:
+            used.append(self.num_calls / self.max_calls)
+        if self.max_tokens:
+            used.append(self.num_tokens / self.max_tokens)
+        if self.max_seconds:
+            used.append(self.seconds() / self.max_seconds)
+        return max(used)
+
+    def check(self):
+        # raises if a limit is hit, must be called with the lock held
+        if self.limit_hit is None:
+            if self.max_calls is not None and self.num_calls >= self.max_calls:
+                self.limit_hit = 'calls'
+            elif self.max_tokens is not None and self.num_tokens >= self.max_tokens:
+                self.limit_hit = 'tokens'
+            elif self.max_seconds is not None and self.seconds() >= self.max_seconds:
+                self.limit_hit = 'seconds'
+        if self.limit_hit is not None:
+            raise BudgetExceeded(self.limit_hit)
+
+    def charge(self, num_tokens: int):
+        '''
+        Charges a request of num_tokens prompt tokens. Raises BudgetExceeded instead if a limit is already hit
+        '''
+        with self.lock:
+            self.check()
+            self.num_calls += 1
+            self.num_tokens += num_tokens
+
+    def add_tokens(self, num_tokens: int):
+        with self.lock:
+            self.num_tokens += num_tokens
+
+    def ret_calls_left(self):
+        # None when calls are not limited
+        return None if self.max_calls is None else max(self.max_calls - self.num_calls, 0)
+
+    def ret_num_agents(self, num_agents: int):
+        return max(1, num_agents - 1) if self.used_fraction() >= self.degrade_at else num_agents
+
+    def ret_num_rounds(self, num_rounds: int):
+        return 1 if self.used_fraction() >= self.single_round_at else num_rounds
+
+    def summary(self):
+        return {"calls": self.num_calls, "tokens": self.num_tokens, "seconds": self.seconds(), "limit_hit": self.limit_hit}
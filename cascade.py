@@ -0,0 +1,104 @@
+'''
+Per stage model cascade: every stage starts on its cheapest model and escalates to a stronger one on low confidence
+'''
+from collections import defaultdict, Counter
+import json
+import os
+import threading
+
+
+# models of each stage (keyed by component), cheapest first
+DEFAULT_CASCADES = {
+    'debate': ['gpt-4o-mini', 'gpt-4o'],
+    'correction': ['gpt-4o-mini', 'gpt-4o'],
+    'extract': ['gpt-4o-mini', 'gpt-4o'],
+    'ranker': ['gpt-4o'],
+    'jury': ['gpt-4o-mini', 'gpt-4o'],
+    'gpt': ['gpt-4o'],
+}
+
+
+class ModelRouter:
+    '''
+    Picks the model of a stage from its cascade by level, 0 being the cheapest. Callers move to the next level when
+        a confidence signal is low: the debate agents disagree, the verifier rejects a correction, the extraction
+        is not a full set of four word board groups, the ranking does not rank the solution's groups or the jury
+        vote is split. Records how often each stage escalated
+    '''
+    def __init__(self, cascades=None, min_agreement=0.6, max_verifier_failures=1):
+        self.cascades = dict(DEFAULT_CASCADES)
+        if cascades:
+            self.cascades.update(cascades)
+        self.min_agreement = min_agreement # share of agent groups backed by a majority of agents below which the debate escalates
+        self.max_verifier_failures = max_verifier_failures # rejected corrections before the correction model escalates
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.num_calls = defaultdict(int) # key: (component, model)
+        self.num_checks = defaultdict(int) # key: component, number of times a signal was checked
+        self.num_escalations = defaultdict(int)
+
+    def model(self, component: str, level=0):
+        cascade = self.cascades[component]
+        return cascade[min(level, len(cascade) - 1)]
+
+    def record_call(self, component: str, model_name: str):
+        # called for every request that is sent, a model picked once can serve many requests
+        with self.lock:
+            self.num_calls[(component, model_name)] += 1
+
+    def max_level(self, component: str):
+        return len(self.cascades[component]) - 1
+
+    def should_escalate(self, component: str, level: int, low_confidence: bool, reason=''):
+        '''
+        Records a confidence check of the stage. Returns True if it is low and a stronger model is left
+        '''
+        with self.lock:
+            self.num_checks[component] += 1
+            if not low_confidence or level >= self.max_level(component):
+                return False
+            self.num_escalations[component] += 1
+        print(f"Escalating {component} to {self.cascades[component][level + 1]}: {reason}")
+        return True
+
+    def agreement(self, solutions):
+        '''
+        Returns the share of groups across solutions that a majority of the solutions contain
+        '''
+        votes = Counter(tuple(sorted(group_words)) for solution in solutions for group_words in solution.values())
+        num_groups = sum(votes.values())
+        if not num_groups:
+            return 0.0
+        majority = len(solutions) // 2 + 1
+        return sum(num_votes for num_votes in votes.values() if num_votes >= majority) / num_groups
+
+    def summary(self):
+        '''
+        Returns a json serializable dict of the calls by "component/model" and of the escalations by component
+        '''
+        with self.lock:
+            return {
+                "model_calls": {f"{component}/{model_name}": num_calls for (component, model_name), num_calls in self.num_calls.items()},
+                "escalations": dict(self.num_escalations),
+            }
+
+    def report(self):
+        '''
+        Returns a table of calls by stage and model and the escalation rate of each stage
+        '''
+        with self.lock:
+            calls = sorted(self.num_calls.items())
+            lines = [f"{'component':<12}{'model':<16}{'calls':>7}"]
+            for (component, model_name), num_calls in calls:
+                lines.append(f"{component:<12}{model_name:<16}{num_calls:>7}")
+            lines.append(f"{'component':<12}{'checks':>7}{'escalated':>11}{'rate':>8}")
+            for component, num_checks in sorted(self.num_checks.items()):
+                num_escalations = self.num_escalations[component]
+                lines.append(f"{component:<12}{num_checks:>7}{num_escalations:>11}{num_escalations / num_checks:>8.1%}")
+        return "\n".join(lines)
+
+
+# cascades can be overridden with a json object such as {"debate": ["gpt-4o"]}
+router = ModelRouter(json.loads(os.environ['MODEL_CASCADES']) if os.environ.get('MODEL_CASCADES') else None)
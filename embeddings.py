@@ -0,0 +1,93 @@
+'''
+Local word vector stage that proposes candidate groups before the debate
+'''
+from functools import lru_cache
+from itertools import combinations
+import numpy as np
+
+
+@lru_cache(maxsize=None)
+def ret_subset_idxs(num_words: int, group_size=4):
+    '''
+    Returns an array of shape (C(num_words, group_size), group_size) with the word idxs of every subset
+    '''
+    return np.array(list(combinations(range(num_words), group_size)), dtype=np.int64).reshape(-1, group_size)
+
+
+class WordVectors:
+    '''
+    Word vectors stored as a .npy matrix (e.g. float16) that is memory mapped, and a vocab file with one word per line
+        in the order of the matrix rows
+    '''
+    def __init__(self, matrix_path: str, vocab_path: str):
+        self.matrix = np.load(matrix_path, mmap_mode='r')
+        with open(vocab_path) as f:
+            self.vocab = {}
+            for i, line in enumerate(f):
+                # keep the first (most frequent) row when the vocab has several casings of a word
+                self.vocab.setdefault(line.strip().upper(), i)
+
+    def ret_vectors(self, words: list[str]):
+        '''
+        Returns (unit length float32 vectors of shape (len(words), dim), bool array of which words were found).
+            Words that are not in the vocab get a zero vector
+        '''
+        vectors = np.zeros((len(words), self.matrix.shape[1]), dtype=np.float32)
+        found = np.zeros(len(words), dtype=bool)
+        for i, word in enumerate(words):
+            # multi word entries such as "ICE CREAM" are looked up with underscores
+            idx = self.vocab.get(word.upper(), self.vocab.get(word.upper().replace(' ', '_')))
+            if idx is not None:
+                vectors[i] = self.matrix[idx]
+                found[i] = True
+
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-8), found
+
+
+class EmbeddingCandidateGenerator:
+    '''
+    Scores every four word subset of the remaining words by cohesion, the mean pairwise cosine similarity of its words,
+        and returns the most cohesive groups
+    '''
+    def __init__(self, word_vectors: WordVectors, k=5):
+        self.word_vectors = word_vectors
+        self.k = k
+
+    def score_subsets(self, words: list[str]):
+        '''
+        Returns (subset idxs of shape (C(n, 4), 4), cohesion scores of shape (C(n, 4),))
+        '''
+        vectors, found = self.word_vectors.ret_vectors(words)
+        similarity = vectors @ vectors.T
+        subset_idxs = ret_subset_idxs(len(words))
+
+        scores = np.zeros(len(subset_idxs), dtype=np.float32)
+        for a, b in combinations(range(4), 2):
+            scores += similarity[subset_idxs[:, a], subset_idxs[:, b]]
+        scores /= 6
+        # a subset with an unknown word has no evidence for it
+        scores[~found[subset_idxs].all(axis=1)] = -1.0
+        return subset_idxs, scores
+
+    def top_groups(self, words: list[str], failed_groups=(), k=None):
+        '''
+        Returns the k most cohesive groups as a list of (group words, score), best first. Failed groups are skipped
+        '''
+        k = k or self.k
+        if len(words) < 4:
+            return []
+        subset_idxs, scores = self.score_subsets(words)
+        failed_keys = set(tuple(sorted(group)) for group in failed_groups)
+
+        num_candidates = min(k + len(failed_keys), len(scores))
+        best = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+        best = best[np.argsort(-scores[best])]
+
+        candidates = []
+        for idx in best:
+            group_words = [words[i] for i in subset_idxs[idx]]
+            if scores[idx] < 0 or tuple(sorted(group_words)) in failed_keys:
+                continue
+            candidates.append((group_words, float(scores[idx])))
+        return candidates[:k]
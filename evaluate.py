@@ -0,0 +1,208 @@
+'''
+Evaluates the solver on a JSONL dataset of puzzles with a process pool. Every line of the dataset is a puzzle
+    {"puzzle_id": "...", "answers": {"THEME": [4 words], ...}} and "words" optionally gives the board order.
+    Results are appended to a JSONL file as puzzles finish, so an interrupted run resumes where it stopped
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+class AnswerKey:
+    '''
+    Oracle that answers submissions from the known solution of the puzzle
+    '''
+    def __init__(self, answers: dict):
+        self.answer_keys = set(tuple(sorted(word.upper() for word in group)) for group in answers.values())
+        self.submissions = [] # list of (group words, correct)
+
+    def __call__(self, group):
+        correct = tuple(sorted(word.upper() for word in group)) in self.answer_keys
+        self.submissions.append((list(group), correct))
+        return correct
+
+
+def load_puzzles(dataset_path: str):
+    '''
+    Yields the puzzles of the dataset one at a time, the line number is the puzzle_id when none is given
+    '''
+    with open(dataset_path) as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            puzzle = json.loads(line)
+            puzzle.setdefault('puzzle_id', str(i))
+            yield puzzle
+
+
+def load_finished(results_path: str):
+    '''
+    Returns the set of puzzle_ids that already have a result. Puzzles that errored are run again
+    '''
+    finished = set()
+    if not os.path.exists(results_path):
+        return finished
+    with open(results_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError: # last line of a run that was killed mid write
+                continue
+            if result.get('outcome') != 'error':
+                finished.add(result['puzzle_id'])
+    return finished
+
+
+def ret_board_words(puzzle: dict):
+    '''
+    Returns the board of the puzzle, the answer words in a fixed random order when the puzzle has no "words"
+    '''
+    if puzzle.get('words'):
+        return [word.upper() for word in puzzle['words']]
+    words = [word.upper() for group in puzzle['answers'].values() for word in group]
+    random.Random(puzzle['puzzle_id']).shuffle(words) # answer order would leak the groups to the debate
+    return words
+
+
+# built once per worker process by init_worker and shared by the puzzles it solves
+engine_kwargs = {}
+budget_limits = {} # limits of the budget each puzzle gets
+
+
+def init_worker(options: dict):
+    from wordplay import WordplayDetector
+    engine_kwargs.update({
+        'pipelined': options.get('pipelined', False),
+        'speculative': options.get('speculative', False),
+        'stream_debate': options.get('stream_debate', False),
+        'stop_early': options.get('stop_early', False),
+        'submit_wordplay': options.get('submit_wordplay', False),
+    })
+    if options.get('wordplay', True):
+        engine_kwargs['wordplay_detector'] = WordplayDetector()
+    budget_limits.update({name: options[name] for name in ('max_calls', 'max_tokens', 'max_seconds') if options.get(name)})
+
+
+def solve_puzzle(puzzle: dict, verbose=False):
+    '''
+    Plays one puzzle against its answer key. Returns the result dict written to the results file
+    '''
+    from main import Engine
+    from tokens import profiler
+    from cascade import router
+    from budget import Budget
+
+    words = ret_board_words(puzzle)
+    oracle = AnswerKey(puzzle['answers'])
+    profiler.reset()
+    router.reset()
+    start = time.perf_counter()
+    output = io.StringIO()
+    result = {"puzzle_id": puzzle['puzzle_id']}
+    budget = Budget(**budget_limits)
+    try:
+        with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(output):
+            engine = Engine(words, oracle=oracle, budget=budget, **engine_kwargs)
+            try:
+                engine.main()
+            finally:
+                if engine.speculator:
+                    engine.speculator.close()
+        result.update({
+            "outcome": "solved" if engine.groups_correct == 4 else "failed",
+            "groups_correct": engine.groups_correct,
+            "num_mistakes": engine.num_mistakes,
+        })
+    except Exception as e:
+        result.update({"outcome": "error", "error": repr(e), "log_tail": output.getvalue()[-2000:]})
+
+    result["seconds"] = time.perf_counter() - start
+    result["submissions"] = oracle.submissions
+    result.update(profiler.summary()) # calls, tokens, per stage timings and time to first group of streamed answers
+    result.update(router.summary())
+    result["limit_hit"] = budget.limit_hit # budget limit that ended the game early, if any
+    return result
+
+
+def run(dataset_path: str, results_path: str, num_workers=4, options=None, verbose=False):
+    '''
+    Solves every puzzle of the dataset that has no result yet. At most 2 * num_workers puzzles are in flight,
+        so the dataset is streamed instead of read into memory
+    '''
+    finished = load_finished(results_path)
+    if finished:
+        print(f"Resuming, {len(finished)} puzzles already have a result")
+
+    num_done = 0
+    counts = {"solved": 0, "failed": 0, "error": 0}
+    with open(results_path, 'a') as results_file, \
+            ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker, initargs=(options or {},)) as executor:
+        if results_file.tell():
+            with open(results_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    results_file.write('\n') # do not glue the first result onto a partial last line
+
+        pending = set()
+        puzzles = (puzzle for puzzle in load_puzzles(dataset_path) if puzzle['puzzle_id'] not in finished)
+        for puzzle in puzzles:
+            pending.add(executor.submit(solve_puzzle, puzzle, verbose))
+            if len(pending) < 2 * num_workers:
+                continue
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            num_done += write_results(done, results_file, counts)
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            num_done += write_results(done, results_file, counts)
+
+    print(f"Finished {num_done} puzzles: {counts}")
+    return counts
+
+
+def write_results(futures, results_file, counts):
+    for future in futures:
+        result = future.result()
+        results_file.write(json.dumps(result) + '\n')
+        results_file.flush()
+        os.fsync(results_file.fileno())
+        counts[result['outcome']] += 1
+        print(f"{result['puzzle_id']}: {result['outcome']}, {result.get('num_mistakes')} mistakes, {result['calls']} calls, "
+              f"{result['prompt_tokens']} prompt tokens, {result['seconds']:.1f}s")
+    return len(futures)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the solver on a JSONL dataset of puzzles")
+    parser.add_argument('dataset')
+    parser.add_argument('results')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--pipelined', action='store_true')
+    parser.add_argument('--speculative', action='store_true')
+    parser.add_argument('--stream-debate', action='store_true')
+    parser.add_argument('--stop-early', action='store_true')
+    parser.add_argument('--submit-wordplay', action='store_true')
+    parser.add_argument('--no-wordplay', action='store_true')
+    parser.add_argument('--max-calls', type=int, help="LLM calls allowed per puzzle")
+    parser.add_argument('--max-tokens', type=int, help="prompt and completion tokens allowed per puzzle")
+    parser.add_argument('--max-seconds', type=float, help="seconds allowed per puzzle")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    options = {
+        'pipelined': args.pipelined,
+        'speculative': args.speculative,
+        'stream_debate': args.stream_debate,
+        'stop_early': args.stop_early,
+        'submit_wordplay': args.submit_wordplay,
+        'wordplay': not args.no_wordplay,
+        'max_calls': args.max_calls,
+        'max_tokens': args.max_tokens,
+        'max_seconds': args.max_seconds,
+    }
+    run(args.dataset, args.results, args.workers, options, args.verbose)
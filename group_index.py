@@ -0,0 +1,75 @@
+'''
+Persistent cross-puzzle index of groups confirmed correct or wrong by the game
+'''
+import sqlite3
+import json
+import threading
+
+
+class GroupIndex:
+    '''
+    SQLite index of every submitted group and its outcome. Groups are also indexed by word, so the known groups that
+        fit on a board are found with one indexed query over the board's words
+    '''
+    def __init__(self, path='group_index.db'):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS groups ("
+                "id INTEGER PRIMARY KEY, group_key TEXT UNIQUE, words TEXT, theme TEXT, "
+                "num_correct INTEGER DEFAULT 0, num_wrong INTEGER DEFAULT 0)")
+            # clustered on word so the groups of a word are stored next to each other
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS group_words ("
+                "word TEXT, group_id INTEGER, PRIMARY KEY (word, group_id)) WITHOUT ROWID")
+
+    def group_key(self, group_words):
+        return '#'.join(sorted(group_words))
+
+    def record(self, group_words: list[str], correct: bool, theme=None):
+        '''
+        Records the outcome of a submitted group
+        '''
+        group_key = self.group_key(group_words)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO groups (group_key, words, theme) VALUES (?, ?, ?) "
+                "ON CONFLICT(group_key) DO UPDATE SET theme = COALESCE(excluded.theme, theme)",
+                (group_key, json.dumps(sorted(group_words)), theme))
+            column = 'num_correct' if correct else 'num_wrong'
+            self.connection.execute(f"UPDATE groups SET {column} = {column} + 1 WHERE group_key = ?", (group_key,))
+            group_id = self.connection.execute("SELECT id FROM groups WHERE group_key = ?", (group_key,)).fetchone()[0]
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO group_words (word, group_id) VALUES (?, ?)",
+                [(word, group_id) for word in set(group_words)])
+
+    def lookup(self, words: list[str]):
+        '''
+        Returns (list of {theme: [group_words]} known to be correct, list of group words known to be wrong) for the
+            groups whose four words are all in words. A group that was ever correct is not ruled out
+        '''
+        if not words:
+            return [], []
+        placeholders = ','.join('?' for _ in words)
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT g.words, g.theme, g.num_correct, g.num_wrong FROM groups g JOIN ("
+                f"SELECT group_id FROM group_words WHERE word IN ({placeholders}) "
+                "GROUP BY group_id HAVING COUNT(*) = 4) m ON g.id = m.group_id "
+                "ORDER BY g.num_correct DESC",
+                list(set(words))).fetchall()
+
+        known_correct = []
+        known_wrong = []
+        for words_json, theme, num_correct, num_wrong in rows:
+            group_words = json.loads(words_json)
+            if num_correct > 0:
+                known_correct.append({theme or "KNOWN GROUP": group_words})
+            elif num_wrong > 0:
+                known_wrong.append(group_words)
+        return known_correct, known_wrong
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,68 @@
+'''
+Persistent conversation history shared between agents, corrections and rankers
+'''
+
+
+class MessageChain:
+    '''
+    Immutable list of chat messages stored as a linked list from the newest message back to the first.
+        Appending is O(1) and returns a new chain, so forks of a history share their common prefix
+        and a history can never be changed by someone else holding a reference to it
+    '''
+    __slots__ = ('message', 'parent', 'length')
+
+    def __init__(self, message=None, parent=None):
+        self.message = message
+        self.parent = parent
+        self.length = 0 if message is None else parent.length + 1
+
+    @classmethod
+    def from_messages(cls, messages):
+        '''
+        Returns a chain from a list of messages (or the chain itself if it already is one)
+        '''
+        if isinstance(messages, MessageChain):
+            return messages
+        chain = EMPTY_CHAIN
+        for message in messages or []:
+            chain = chain.append(message)
+        return chain
+
+    def append(self, message):
+        return MessageChain(dict(message), self)
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __getitem__(self, idx: int):
+        if idx < 0:
+            idx += self.length
+        if idx < 0 or idx >= self.length:
+            raise IndexError("MessageChain index out of range")
+        node = self
+        for _ in range(self.length - 1 - idx):
+            node = node.parent
+        return node.message
+
+    def to_list(self):
+        '''
+        Returns the messages oldest first as a new list
+        '''
+        messages = []
+        node = self
+        while node.length:
+            messages.append(node.message)
+            node = node.parent
+        return messages[::-1]
+
+    def __repr__(self):
+        return f"MessageChain({self.to_list()})"
+
+
+EMPTY_CHAIN = MessageChain()
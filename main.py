@@ -2,18 +2,45 @@ from openai import OpenAI
 from dotenv import load_dotenv
 import json 
 import pdb 
-from model import Replanner, Orchestrator, Debate, Verifier, Ranker
+from model import Replanner, Orchestrator, Debate, Verifier, Ranker, Speculator
+from tokens import profiler
+from cascade import router
+import metrics
+from embeddings import WordVectors, EmbeddingCandidateGenerator
+from wordplay import WordplayDetector
+from group_index import GroupIndex
+from board_memo import BoardMemo
+from budget import Budget
+import os
 
 '''
 '''
 load_dotenv()
 
 class Engine:
-    def __init__(self, all_words: list[str]):
+    def __init__(self, all_words: list[str], pipelined=False, speculative=False, max_wasted_calls=30, stream_debate=False, stop_early=False,
+                 candidate_generator=None, wordplay_detector=None, submit_wordplay=False, group_index=None,
+                 board_memo=None, oracle=None, budget=None, concurrent_ranking=False):
         self.groups_correct = 0
         self.num_mistakes = 0
+        self.all_words = list(all_words)
         self.remaining_words = all_words
         self.failed_groups = []
+        self.solved_groups = []
+        self.pipelined = pipelined # stream agent answers through the round instead of waiting for every stage
+        # debates the next round for the failure of a submission, max_wasted_calls bounds the calls of cancelled branches
+        self.speculator = Speculator(max_wasted_calls) if speculative else None
+        self.stream_debate = stream_debate # stream debate answers, stop_early ends them once they hold a full set of groups
+        self.stop_early = stop_early
+        self.candidate_generator = candidate_generator # proposes groups from word vectors before each debate
+        self.wordplay_detector = wordplay_detector # proposes lexical groups, submit_wordplay submits confident ones without an LLM call
+        self.submit_wordplay = submit_wordplay
+        self.group_index = group_index # on disk outcomes of submitted groups shared across games
+        self.board_memo = board_memo # replays boards that were played before, the solver only runs for unseen states
+        self.oracle = oracle # submits a group and returns if it was correct, the groups are asked on stdin when None
+        self.budget = budget # per puzzle limits on calls, tokens and seconds, unlimited when None
+        self.ranked_groups = [] # ranking of the last round, submitted as the best so far once the budget is spent
+        self.concurrent_ranking = concurrent_ranking # rank the solutions of a round at once instead of one after the other
     
     def update_remaining_words(self, success_group: list[str]):
         new_remaining_words = [word for word in self.remaining_words if word not in success_group]
@@ -75,27 +102,60 @@ class Engine:
         self.num_mistakes += 1
     
     def main(self):
+        num_idle_rounds = 0 # consecutive rounds that submitted nothing
         while(self.groups_correct < 4 and self.num_mistakes < 4):
             # generate the list of groups to try 
-            orchestrator = Orchestrator(self.remaining_words, self.groups_correct, self.failed_groups)
+            orchestrator = Orchestrator(self.remaining_words, self.groups_correct, self.failed_groups, pipelined=self.pipelined,
+                                        speculator=self.speculator, num_mistakes=self.num_mistakes,
+                                        stream_debate=self.stream_debate, stop_early=self.stop_early,
+                                        candidate_generator=self.candidate_generator,
+                                        wordplay_detector=self.wordplay_detector, submit_wordplay=self.submit_wordplay,
+                                        group_index=self.group_index, board_memo=self.board_memo,
+                                        all_words=self.all_words, solved_groups=self.solved_groups, oracle=self.oracle,
+                                        budget=self.budget, prior_ranked_groups=self.ranked_groups,
+                                        concurrent_ranking=self.concurrent_ranking)
 
             groups_solved, failed_group = orchestrator.run_round()
+            if orchestrator.ranked_groups:
+                self.ranked_groups = orchestrator.ranked_groups
             if failed_group:
                 self.failed_groups.append(failed_group)
 
             # update available words
             for group in groups_solved:
                 self.update_remaining_words(group)
+                self.solved_groups.append(group)
 
             self.groups_correct += len(groups_solved)
 
-            if self.groups_correct < 4:
+            if failed_group:
                 self.num_mistakes += 1
 
+            # nothing was left to submit: the debate is rerun once, unless the budget is spent
+            if groups_solved or failed_group:
+                num_idle_rounds = 0
+            else:
+                num_idle_rounds += 1
+                if num_idle_rounds > 1 or (self.budget is not None and self.budget.limit_hit):
+                    print("No group left to submit")
+                    break
+
+        if self.speculator:
+            self.speculator.close()
+
+        metrics.puzzle_outcomes.inc('solved' if self.groups_correct == 4 else 'failed')
+        metrics.puzzle_mistakes.observe(value=self.num_mistakes)
+        if os.environ.get('METRICS_PATH'):
+            metrics.registry.write(os.environ['METRICS_PATH'])
+
         if self.groups_correct == 4:
             print("Congratulations! You solved the puzzle.")
         else:
             print("Try again next time.")
+        print(f"Prompt tokens by stage:\n{profiler.report()}")
+        print(f"Model cascade:\n{router.report()}")
+        if self.budget is not None:
+            print(f"Budget: {self.budget.summary()}")
         
 
 
@@ -104,5 +164,16 @@ class Engine:
 
 if __name__ == "__main__":
     words = ["WAX", "MUMMY", "GIFT", "ANCHOR", "BURRITO", "PRESENT", "CLAY", "PAPYRUS", "SPRAIN", "FLAIR", "MODERATE", "TALENT", "INSTINCT", "PARCHMENT", "HOST", "FACULTY"]
-    game_engine = Engine(words)
+    candidate_generator = None
+    if os.environ.get('WORD_VECTORS_PATH'):
+        word_vectors = WordVectors(os.environ['WORD_VECTORS_PATH'], os.environ['WORD_VOCAB_PATH'])
+        candidate_generator = EmbeddingCandidateGenerator(word_vectors)
+    if os.environ.get('METRICS_PORT'):
+        metrics.registry.serve(int(os.environ['METRICS_PORT']))
+    group_index = GroupIndex(os.environ.get('GROUP_INDEX_PATH', 'group_index.db'))
+    board_memo = BoardMemo(os.environ.get('BOARD_MEMO_PATH', 'board_memo.db'))
+    limits = {name: float(os.environ[env]) for name, env in
+              [('max_calls', 'PUZZLE_MAX_CALLS'), ('max_tokens', 'PUZZLE_MAX_TOKENS'), ('max_seconds', 'PUZZLE_MAX_SECONDS')] if os.environ.get(env)}
+    game_engine = Engine(words, candidate_generator=candidate_generator, wordplay_detector=WordplayDetector(), group_index=group_index,
+                         board_memo=board_memo, budget=Budget(**limits))
     game_engine.main()
\ No newline at end of file
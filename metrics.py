@@ -0,0 +1,136 @@
+'''
+In-process metrics registry (counters and histograms with labels) exported in the Prometheus text format
+'''
+from bisect import bisect_left
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = defaultdict(float) # key: tuple of label values
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labelvalues, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, labelvalues)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.counts = {} # key: tuple of label values, val: count per bucket, the last one is +Inf
+        self.sums = defaultdict(float)
+
+    def observe(self, *labelvalues, value):
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            if labelvalues not in self.counts:
+                self.counts[labelvalues] = [0] * (len(self.buckets) + 1)
+            self.counts[labelvalues][idx] += 1
+            self.sums[labelvalues] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labelvalues, counts in sorted(self.counts.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labelvalues, [('le', le)])} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, labelvalues)} {self.sums[labelvalues]:g}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    '''
+    Holds the metrics of the process. Recording is a dict update under the lock of one metric,
+        the text format is only built when the metrics are exported
+    '''
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        # written to a temporary file first so a scraper never reads a partial dump
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port=9100, host='127.0.0.1'):
+        '''
+        Serves the metrics on http://host:port/metrics from a daemon thread. Returns the server
+        '''
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+registry = MetricsRegistry()
+
+llm_calls = registry.register(Counter('llm_calls_total', 'LLM requests by model and stage', ['model', 'stage']))
+llm_latency = registry.register(Histogram('llm_request_seconds', 'LLM request latency by model and stage', ['model', 'stage']))
+llm_prompt_tokens = registry.register(Counter('llm_prompt_tokens_total', 'Prompt tokens sent by model and stage', ['model', 'stage']))
+llm_completion_tokens = registry.register(Counter('llm_completion_tokens_total', 'Completion tokens received by model and stage', ['model', 'stage']))
+debate_first_group = registry.register(Histogram('debate_first_group_seconds', 'Time from a streamed debate request to its first parsed group',
+                                                 ['model']))
+verifier_failures = registry.register(Counter('verifier_failures_total', 'Solutions rejected by the verifier by reason', ['reason']))
+correction_iterations = registry.register(Histogram('correction_iterations', 'Corrections needed before a solution passed the verifier',
+                                                    buckets=(0, 1, 2, 3, 5, 10)))
+jury_agreement = registry.register(Histogram('jury_agreement', 'Share of judges that voted with the majority on a group',
+                                             buckets=(0.5, 0.6, 0.7, 0.8, 0.9, 1.0)))
+puzzle_outcomes = registry.register(Counter('puzzle_outcomes_total', 'Finished games by outcome', ['outcome']))
+puzzle_mistakes = registry.register(Histogram('puzzle_mistakes', 'Mistakes made in a finished game', buckets=(0, 1, 2, 3, 4)))
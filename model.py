@@ -6,71 +6,281 @@ from dotenv import load_dotenv
 import json 
 import pdb 
 from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+import threading
+import re
+import time
 import math 
 import numpy as np 
 from constants import incorrect_json_str, plan_generator_system_prompt, replan_generator_system_prompt
 import copy 
 import agentops
 import os
+from tokens import context_guard, profiler, count_tokens
+from history import MessageChain
+from cascade import router
+from budget import BudgetExceeded
+from replay import RecordingClient, ReplayClient
+import metrics
 
 load_dotenv()
 agentops.init(os.environ['AGENT_OPS_KEY'])
 
 
+shared_client = None
+shared_client_lock = threading.Lock()
+
+
+def get_client():
+    '''
+    Returns the client shared by every model, so its connection pool is reused across agents and games.
+        LLM_REPLAY_PATH answers from a recording (delays scaled by LLM_REPLAY_LATENCY_SCALE), LLM_RECORD_PATH records every exchange
+    '''
+    global shared_client
+    with shared_client_lock:
+        if shared_client is None:
+            if os.environ.get('LLM_REPLAY_PATH'):
+                shared_client = ReplayClient(os.environ['LLM_REPLAY_PATH'], float(os.environ.get('LLM_REPLAY_LATENCY_SCALE', 1.0)))
+            elif os.environ.get('LLM_RECORD_PATH'):
+                shared_client = RecordingClient(OpenAI(), os.environ['LLM_RECORD_PATH'])
+            else:
+                shared_client = OpenAI()
+        return shared_client
+
+
+def set_client(client):
+    '''
+    Replaces the shared client (e.g. with a batch client). Models created afterwards use it
+    '''
+    global shared_client
+    with shared_client_lock:
+        shared_client = client
+
+
+def create_completion(client, model_name, messages, stage: str, component: str, budget=None, **kwargs):
+    '''
+    Sends a chat completion request after fitting the messages into the token budget of the component.
+        Tokens and latency are recorded by stage and component in the profiler. The request is charged to the
+        puzzle budget when one is given, which raises BudgetExceeded instead of sending it once a limit is hit
+    '''
+    messages, num_tokens, num_trimmed = context_guard.fit(messages, component, model_name)
+    if budget is not None:
+        budget.charge(num_tokens)
+    router.record_call(component, model_name)
+    profiler.record(stage, component, num_tokens, num_trimmed)
+    metrics.llm_calls.inc(model_name, stage)
+    metrics.llm_prompt_tokens.inc(model_name, stage, amount=num_tokens)
+    start = time.perf_counter()
+    response = client.chat.completions.create(model=model_name, messages=messages, **kwargs)
+    if not kwargs.get('stream'): # streamed responses are timed by their reader
+        usage = getattr(response, 'usage', None)
+        completion_tokens = usage.completion_tokens if usage else 0
+        record_response(model_name, stage, component, time.perf_counter() - start, completion_tokens)
+        if budget is not None:
+            budget.add_tokens(completion_tokens)
+    return response
+
+
+def record_response(model_name, stage: str, component: str, seconds: float, completion_tokens=0):
+    profiler.record_response(stage, component, seconds, completion_tokens)
+    metrics.llm_latency.observe(model_name, stage, value=seconds)
+    metrics.llm_completion_tokens.inc(model_name, stage, amount=completion_tokens)
+
 
 class Orchestrator:
     '''
     Generates the responses from the agents after debate, verifies and does feedback, ranks the outputs, generates a list of groups to try
         and it executes action 
     '''
-    def __init__(self, remaining_words, groups_correct:int, failed_groups: list[str]):
+    def __init__(self, remaining_words, groups_correct:int, failed_groups: list[str], pipelined=False, min_votes=None,
+                 speculator=None, num_mistakes=0, stream_debate=False, stop_early=False, candidate_generator=None, seed_vote_weight=1,
+                 wordplay_detector=None, submit_wordplay=False, group_index=None, board_memo=None, all_words=None, solved_groups=(),
+                 oracle=None, budget=None, prior_ranked_groups=(), max_corrections=3, concurrent_ranking=False):
         self.remaining_words = remaining_words
         self.groups_correct = groups_correct
-        self.debater = Debate(self.remaining_words, num_rounds=2, num_agents=3)
         self.failed_groups = failed_groups
+        self.group_index = group_index # groups confirmed correct or wrong in earlier games
+        self.known_correct, self.known_wrong = group_index.lookup(remaining_words) if group_index else ([], [])
+        self.board_memo = board_memo # rankings and outcomes of earlier games on the same board
+        self.all_words = all_words or remaining_words
+        self.oracle = oracle # callable that submits a group and returns if it was correct, asks on stdin when None
+        self.memo_correct = []
+        if board_memo is not None:
+            self.state_key = board_memo.state_key(self.all_words, failed_groups, solved_groups)
+            self.memo_correct, memo_wrong = board_memo.lookup_outcomes(self.all_words)
+            self.known_wrong = self.known_wrong + memo_wrong
+        self.group_themes = {} # key: tuple of group words (alpha sorted), val: theme given by the debate or local stages
+        self.candidate_generator = candidate_generator # local stage that proposes groups before the debate
+        self.seed_vote_weight = seed_vote_weight # votes given to each proposed group when ranking
+        self.wordplay_detector = wordplay_detector # local stage that finds lexical groups (compounds, affixes, hidden words)
+        self.submit_wordplay = submit_wordplay # submit confident lexical groups before any LLM call
+        self.seed_groups = self.ret_candidate_groups(self.remaining_words, self.failed_groups)
+        # pipelined rounds submit before the agents' agreement is known, so they debate on the strongest model
+        self.debate_level = router.max_level('debate') if pipelined else 0
+        # the puzzle budget shrinks the debate as it runs low, and past its limits the best groups so far are submitted
+        self.budget = budget
+        self.prior_ranked_groups = list(prior_ranked_groups) # ranking of the previous round, submitted when the budget is spent
+        self.max_corrections = max_corrections # corrections asked per agent before its solution is dropped
+        self.cancel_event = None # set by a pipelined round once it returns
+        self.concurrent_ranking = concurrent_ranking # rank the verified solutions at once, each in its own fork of the ranker
+        num_agents, num_rounds = self.ret_debate_size(3, 2)
+        if (num_agents, num_rounds) != (3, 2):
+            print(f"Budget running low, debating with {num_agents} agents for {num_rounds} rounds")
+        self.debater = Debate(self.remaining_words, num_rounds=num_rounds, num_agents=num_agents, stream=stream_debate, stop_early=stop_early,
+                              candidate_groups=self.seed_groups, level=self.debate_level, budget=budget)
+        self.debater.update_failed_groups(self.ret_ruled_out_groups(self.remaining_words, self.failed_groups))
+        self.speculator = speculator # precomputes the next round's debate while a group is submitted
+        self.num_mistakes = num_mistakes
+        self.pipelined = pipelined # stream each agent answer through extraction, correction and ranking
+        self.min_votes = min_votes or self.debater.num_agents // 2 + 1 # agent votes needed to submit a group before all agents are ranked
 
         self.ranked_solutions = [] # list of dicts where key is rank and value is group 
         self.used_words = set() #keeps track of words that have been succesfully submitted 
         self.ranked_groups = []
     
+    def ret_debate_size(self, num_agents: int, num_rounds: int):
+        '''
+        Returns (num_agents, num_rounds) of the debate under the budget. Past its thresholds the budget drops an agent,
+            then a round. The debate then shrinks (agents down to 2, rounds, then agents) until a round fits in the calls
+            left, where every agent makes num_rounds debate calls, one extraction and two ranking calls
+        '''
+        if self.budget is None:
+            return num_agents, num_rounds
+        num_agents, num_rounds = self.budget.ret_num_agents(num_agents), self.budget.ret_num_rounds(num_rounds)
+        calls_left = self.budget.ret_calls_left()
+        while calls_left is not None and num_agents * (num_rounds + 3) > calls_left and num_agents * num_rounds > 1:
+            if num_agents > 2:
+                num_agents -= 1
+            elif num_rounds > 1:
+                num_rounds -= 1
+            else:
+                num_agents -= 1
+        return num_agents, num_rounds
+
     def ret_ranked_groups(self):
         '''
         Returns a sorted list of groups, sorted by the groups with most votes across solutions, ties broken by rank 
         '''
-        # TODO: change the hash to tuple, alphabetically sorted
-        # get number votes of each group
-        num_votes = defaultdict(int)
-        
-        ranks = defaultdict(list) # index is list of words converted to string using '#'.join
-        for i in range(0, len(self.ranked_solutions)):
-            sol = self.ranked_solutions[i]
-            for rank, group_words in sol.items():
-                group_key = tuple(sorted(group_words)) #key is tuple of group set (alpha sorted for order invariance)
-                ranks[group_key].append(int(rank))
-                num_votes[group_key] += 1
+        tally = self.ret_seeded_tally()
+        for sol in self.ranked_solutions:
+            tally.add_solution(sol)
 
-        # get average rank of each group   
-        avg_ranks = {} #key: group_hash, val: avg_rank
-        for group_hash, ranks in ranks.items():
-            avg_ranks[group_hash] = float(np.mean(ranks))
-
-
-        group_items = [] #(group_hash, num_votes, avg_rank)
-        for group_hash in num_votes.keys():
-            group_list = list(group_hash)
-            votes = num_votes[group_hash]
-            avg_rank = avg_ranks[group_hash]
+        self.ranked_groups = tally.ranked_groups()
+        return self.ranked_groups
 
-            group_items.append((group_list, votes, avg_rank))
+    def ret_candidate_groups(self, words, failed_groups):
+        '''
+        Returns the list of {category: [group_words]} proposed by the local stages, groups known from earlier games first
+        '''
+        failed_groups = self.ret_ruled_out_groups(words, failed_groups)
+        candidates = [group for group in self.known_correct if set(list(group.values())[0]) <= set(words)]
+        if self.wordplay_detector is not None:
+            for group_words, theme, score in self.wordplay_detector.top_groups(words, failed_groups):
+                candidates.append({theme: group_words})
+        if self.candidate_generator is not None:
+            for group_words, score in self.candidate_generator.top_groups(words, failed_groups):
+                candidates.append({"SIMILAR MEANING": group_words})
+
+        # keep the first proposal of every group
+        seen = set()
+        unique_candidates = []
+        for candidate in candidates:
+            group_key = tuple(sorted(list(candidate.values())[0]))
+            if group_key not in seen:
+                seen.add(group_key)
+                unique_candidates.append(candidate)
+                self.group_themes.setdefault(group_key, list(candidate.keys())[0])
+        return unique_candidates
+
+    def update_group_themes(self, solution):
+        # themes named by the agents replace the placeholder themes of the local stages
+        for theme, group_words in solution.items():
+            group_key = tuple(sorted(group_words))
+            if self.group_themes.get(group_key) in (None, "SIMILAR MEANING", "KNOWN GROUP"):
+                self.group_themes[group_key] = theme
+
+    def ret_ruled_out_groups(self, words, failed_groups):
+        '''
+        Returns failed_groups and the groups known to be wrong from earlier games that fit in words
+        '''
+        failed_keys = set(tuple(sorted(group)) for group in failed_groups)
+        known_wrong = [group for group in self.known_wrong if set(group) <= set(words) and tuple(sorted(group)) not in failed_keys]
+        return list(failed_groups) + known_wrong
+
+    def ret_seeded_tally(self):
+        # candidate groups count as extra votes, ranked in the order they were proposed
+        tally = VoteTally()
+        for rank, candidate in enumerate(self.seed_groups, start=1):
+            tally.add_group(list(candidate.values())[0], rank, self.seed_vote_weight)
+        return tally
+
+    def run_wordplay_round(self):
+        '''
+        Submits the confident lexical groups without any LLM call. Returns (list of successful groups, failed group if exists)
+            or None if there are no confident lexical groups
+        '''
+        confident_groups = self.wordplay_detector.confident_groups(self.ret_unused_words(), self.failed_groups)
+        if not confident_groups:
+            return None
+
+        successful_groups = []
+        for group_words, theme, score in confident_groups:
+            if self.groups_correct >= 4:
+                break
+            print(f"Wordplay group {theme} ({score:.2f}): {group_words}")
+            if not self.execute_with_speculation(group_words):
+                return successful_groups, group_words
+            successful_groups.append(group_words)
+            self.update_used_words(group_words)
+            self.groups_correct += 1
+        return successful_groups, None
+
+    def run_memo_round(self):
+        '''
+        Submits the groups confirmed correct on this board in an earlier game. Returns (list of successful groups, failed group if exists)
+            or None if there are none left
+        '''
+        unused_words = set(self.ret_unused_words())
+        memo_groups = [group for group in self.memo_correct if set(group) <= unused_words]
+        if not memo_groups:
+            return None
+
+        successful_groups = []
+        for group_words in memo_groups:
+            if self.groups_correct >= 4:
+                break
+            print(f"Replaying solved group: {group_words}")
+            if not self.record_outcome(group_words, self.execute_group(group_words)):
+                return successful_groups, group_words
+            successful_groups.append(group_words)
+            self.update_used_words(group_words)
+            self.groups_correct += 1
+        return successful_groups, None
+
+    def ret_memo_ranking(self):
+        # the ranked groups of an earlier game in this state, without the groups that can no longer be submitted
+        if self.board_memo is None:
+            return None
+        ranked_groups = self.board_memo.lookup_ranking(self.state_key)
+        if not ranked_groups:
+            return None
+        self.ranked_groups = ranked_groups
+        try:
+            self.get_next_group()
+        except ValueError:
+            return None
+        return ranked_groups
 
-        sorted_group_items = sorted(group_items, key=lambda x: (-x[1], x[2])) #sort first by num votes, then avg_rank
-        self.ranked_groups = [tup[0] for tup in sorted_group_items]
-        return self.ranked_groups
+    def memoize_ranking(self, ranked_groups):
+        if self.board_memo is not None:
+            self.board_memo.record_ranking(self.state_key, ranked_groups)
 
     def get_next_group(self):
-        # return first group that does not use already used words 
+        # return first group that does not use already used words and is not known to be wrong
+        known_wrong_keys = set(tuple(sorted(group)) for group in self.known_wrong)
         for group in self.ranked_groups:
-            if len(set(group) & self.used_words) == 0:
+            if len(set(group) & self.used_words) == 0 and tuple(sorted(group)) not in known_wrong_keys:
                 return group 
         
         raise ValueError("No groups that don't include some of the used words")
@@ -82,47 +292,170 @@ class Orchestrator:
         
         return 
 
+    def ret_unused_words(self):
+        return [word for word in self.remaining_words if word not in self.used_words]
+
+    def ret_debate_solutions(self):
+        '''
+        Returns the solutions of the debate, taken from a speculative branch when one was started for this round
+        '''
+        self.debater.update_failed_groups(self.ret_ruled_out_groups(self.remaining_words, self.failed_groups))
+        if self.speculator:
+            branch = self.speculator.take(self.remaining_words, self.failed_groups)
+            if branch:
+                self.debater = branch.debater
+                return self.escalate_debate(branch.result())
+        return self.escalate_debate(self.debater.driver())
+
+    def escalate_debate(self, solutions):
+        '''
+        Reruns the debate on the next model of the cascade while the agents disagree. Returns the solutions of the last debate
+        '''
+        agreement = router.agreement(solutions)
+        while router.should_escalate('debate', self.debater.level, agreement < router.min_agreement, f"agent agreement {agreement:.2f}"):
+            debater = Debate(self.debater.available_words, num_rounds=self.debater.num_rounds, num_agents=self.debater.num_agents,
+                             stream=self.debater.stream, stop_early=self.debater.stop_early,
+                             candidate_groups=self.debater.candidate_groups, level=self.debater.level + 1, budget=self.budget)
+            debater.update_failed_groups(self.debater.failed_groups)
+            self.debater = debater
+            solutions = self.debater.driver()
+            agreement = router.agreement(solutions)
+        return solutions
+
+    def execute_with_speculation(self, group):
+        '''
+        Submits group while the next round's debate runs for its failure. A success moves on to the next ranked
+            group without a new debate, so only a failure needs one. Returns boolean if group was successful
+        '''
+        if self.speculator is None:
+            return self.record_outcome(group, self.execute_group(group))
+
+        unused_words = self.ret_unused_words()
+        failed_groups = self.failed_groups + [group]
+        if self.num_mistakes + 1 < 4:
+            self.speculator.start(unused_words, failed_groups, self.ret_speculative_debate(unused_words, failed_groups))
+
+        result = self.record_outcome(group, self.execute_group(group))
+        if result:
+            self.speculator.resolve(None, None) # the failure branch is not needed
+        else:
+            self.speculator.resolve(unused_words, failed_groups)
+        return result
+
+    def record_outcome(self, group, result):
+        # stores the outcome of a submitted group for later games
+        if self.group_index is not None:
+            self.group_index.record(group, result, self.group_themes.get(tuple(sorted(group))))
+        if self.board_memo is not None:
+            self.board_memo.record_outcome(self.all_words, group, result)
+        return result
+
+    def ret_speculative_debate(self, words, failed_groups):
+        debater = Debate(words, num_rounds=self.debater.num_rounds, num_agents=self.debater.num_agents, cancel_event=threading.Event(),
+                         stream=self.debater.stream, stop_early=self.debater.stop_early,
+                         candidate_groups=self.ret_candidate_groups(words, failed_groups), level=self.debate_level, budget=self.budget)
+        debater.update_failed_groups(self.ret_ruled_out_groups(words, failed_groups))
+        return debater
+
+    def correct_solution(self, i, solution):
+        '''
+        Asks agent i to correct its solution until it satisfies the rules. Returns the valid solution, or None once
+            self.max_corrections corrections were rejected. The correction model escalates after router.max_verifier_failures
+            rejected corrections
+        '''
+        level = 0
+        num_rejected = 0 # corrections rejected on the current level
+        num_corrections = 0
+        while True:
+            verifier = Verifier([solution], self.remaining_words)
+            is_valid = verifier.ret_solutions_valid()[0]
+            if num_corrections:
+                num_rejected += int(not is_valid)
+                if router.should_escalate('correction', level, num_rejected >= router.max_verifier_failures,
+                                          f"{num_rejected} corrections rejected by the verifier"):
+                    level += 1
+                    num_rejected = 0
+            if is_valid:
+                metrics.correction_iterations.observe(value=num_corrections)
+                self.update_group_themes(solution)
+                return solution
+            if num_corrections >= self.max_corrections:
+                print(f"Dropping the solution of agent {i} after {num_corrections} rejected corrections")
+                return None
+
+            context = self.debater.agent_contexts[i] # forks share the debate history, nothing is copied
+            if len(self.failed_groups):
+                context = context.append({"role": "user", "content": f"Also use the fact that the incorrect groups of words are {self.failed_groups}"})
+            correction_prompt = verifier.correction_prompts[0]
+
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                raise DebateCancelled("Pipelined round ended")
+            model = Model(router.model('correction', level), history=context, component='correction', budget=self.budget)
+            text_response = model.forward(correction_prompt, stage='correction')
+            solution = self.debater.get_json_puzzle_solution(text_response)
+            num_corrections += 1
+
     def run_round(self):
         '''
         Executes a round. Returns (list of successful groups, failed group if exists)
         '''
-        successful_groups = [] 
-        all_sols_valid = False 
-        self.debater.update_failed_groups(self.failed_groups)
-        list_sols = self.debater.driver()
-
-        # continues to generate responses until satisfies all the rules 
-        while (all_sols_valid == False):
-            verifier = Verifier(list_sols, self.remaining_words)
-            are_sols_valid = verifier.ret_solutions_valid()
-            if not all(are_sols_valid):
-                # update the solutions for the ones that failed
-                for i in range(0, len(are_sols_valid)):
-                    if not are_sols_valid[i]:
-                        context = self.debater.agent_contexts[i].copy()
-                        if len(self.failed_groups):
-                            context.append({'user': f"Also use the fact that the incorrect groups of words are {self.failed_groups}"})
-                        correction_prompt = verifier.correction_prompts[i]
-    
-                        model = Model('gpt-4o',history=context)
-                        text_response = model.forward(correction_prompt)
-                        list_sols[i] = self.debater.get_json_puzzle_solution(text_response)
-            
-            all_sols_valid = all(are_sols_valid)            
-        
-        ranker = Ranker(list_sols)
-        ranked_sols = ranker.rank_solutions()
+        if self.board_memo is not None:
+            round_result = self.run_memo_round()
+            if round_result is not None:
+                return round_result
+            # a state seen before is replayed from its ranking without any LLM call
+            if self.ret_memo_ranking() is not None:
+                print("Replaying memoized ranking")
+                return self.submit_ranked_groups()
+
+        if self.submit_wordplay and self.wordplay_detector is not None:
+            round_result = self.run_wordplay_round()
+            if round_result is not None:
+                return round_result
+
+        if self.pipelined:
+            return self.run_round_pipelined()
+
+        verified_sols = []
+        ranker = None
+        try:
+            list_sols = self.ret_debate_solutions()
+
+            # continues to generate responses until satisfies all the rules 
+            for i in range(0, len(list_sols)):
+                solution = self.correct_solution(i, list_sols[i])
+                if solution is not None:
+                    verified_sols.append(solution)
+            if not verified_sols:
+                print("No solution passed the verifier, submitting the best groups so far")
+                return self.submit_best_so_far()
+
+            ranker = Ranker(verified_sols, budget=self.budget)
+            ranked_sols = ranker.rank_concurrently() if self.concurrent_ranking else ranker.rank_solutions()
+        except BudgetExceeded as e:
+            print(f"{e}, submitting the best groups so far")
+            return self.submit_best_so_far(self.ret_partial_groups(verified_sols, ranker.ranked_solutions if ranker else []))
         self.ranked_solutions = ranked_sols
 
         ranked_groups = self.ret_ranked_groups() #TODO: FIX: SHOULD BE MORE THAN 4
         self.ranked_groups = ranked_groups
+        self.memoize_ranking(list(ranked_groups))
+        return self.submit_ranked_groups()
 
+    def submit_ranked_groups(self):
+        '''
+        Submits self.ranked_groups in order until one fails. Returns (list of successful groups, failed group if exists)
+        '''
+        successful_groups = []
         result = True
         while(result):
             if self.groups_correct >= 4: break 
 
-            next_group = self.get_next_group()
-            result = self.execute_group(next_group)
+            try:
+                next_group = self.get_next_group()
+            except ValueError: # every ranked group overlaps a solved one or is known to be wrong
+                break
+            result = self.execute_with_speculation(next_group)
             if result:
                 successful_groups.append(next_group)
                 self.update_used_words(next_group)
@@ -130,14 +463,153 @@ class Orchestrator:
             
             self.ranked_groups.remove(next_group)
 
-        if self.groups_correct >= 4:
+        if self.groups_correct >= 4 or result:
             return successful_groups, None 
     
         return successful_groups, next_group 
 
+    def ret_partial_groups(self, verified_sols, ranked_sols):
+        '''
+        Returns the groups of a round that was cut by the budget: the ranked solutions, then the verified solutions
+            that were not ranked yet in agent order, then the groups parsed from the agents' latest debate answers
+        '''
+        tally = VoteTally()
+        for ranked_solution in ranked_sols:
+            tally.add_solution(ranked_solution)
+        for solution in verified_sols[len(ranked_sols):]:
+            for rank, group_words in enumerate(solution.values(), start=1):
+                tally.add_group(group_words, rank)
+        answer_tally = VoteTally()
+        for agent_context in self.debater.agent_contexts:
+            if len(agent_context) and agent_context[-1]["role"] == "assistant":
+                parser = GroupStreamParser(self.remaining_words)
+                parser.feed(agent_context[-1]["content"])
+                for rank, (_, group_words) in enumerate(parser.groups, start=1):
+                    answer_tally.add_group(group_words, rank)
+        return tally.ranked_groups() + answer_tally.ranked_groups()
+
+    def is_budget_spent(self):
+        return self.budget is not None and self.budget.limit_hit is not None
+
+    def submit_best_so_far(self, leading_groups=()):
+        '''
+        Submits the best groups known without another LLM call: leading_groups, the ranking of the previous round,
+            the local proposals and the last four words. Returns (list of successful groups, failed group if exists)
+        '''
+        unused_words = set(self.ret_unused_words())
+        ruled_out = {tuple(sorted(group)) for group in self.ret_ruled_out_groups(self.remaining_words, self.failed_groups)}
+        self.ranked_groups = []
+        forced_groups = [sorted(unused_words)] if len(unused_words) == 4 else [] # the last four words are a group
+        for group in list(leading_groups) + self.prior_ranked_groups + self.ret_seeded_tally().ranked_groups() + forced_groups:
+            group_key = tuple(sorted(group))
+            if set(group) <= unused_words and group_key not in ruled_out and list(group_key) not in self.ranked_groups:
+                self.ranked_groups.append(list(group_key))
+        if not self.ranked_groups:
+            return [], None
+        return self.submit_ranked_groups()
+
+    def submit_group(self, group, successful_groups):
+        '''
+        Submits group and updates the round state. Returns boolean if group was successful
+        '''
+        result = self.execute_with_speculation(group)
+        if result:
+            successful_groups.append(group)
+            self.update_used_words(group)
+            self.groups_correct += 1
+
+        self.submitted_groups.add(tuple(sorted(group)))
+        return result
+
+    def ret_unsubmitted_groups(self, tally):
+        return [group for group in tally.ranked_groups() if tuple(sorted(group)) not in self.submitted_groups]
+
+    def run_round_pipelined(self):
+        '''
+        Executes a round where every agent's final answer flows into extraction, correction and ranking as soon as
+            it is ready. Groups are submitted once self.min_votes agents voted for them, before the other agents are ranked.
+            Returns (list of successful groups, failed group if exists)
+        '''
+        successful_groups = []
+        self.submitted_groups = set()
+        self.debater.update_failed_groups(self.ret_ruled_out_groups(self.remaining_words, self.failed_groups))
+        branch = self.speculator.take(self.remaining_words, self.failed_groups) if self.speculator else None
+        if branch:
+            self.debater = branch.debater
+        # set when the round returns, so the jobs still running make no further call
+        stop = threading.Event()
+        self.cancel_event = stop
+        self.debater.cancel_event = stop
+        ranker = Ranker([], budget=self.budget, cancel_event=stop)
+        tally = self.ret_seeded_tally()
+        results = queue.Queue() # finished futures, consumed by this thread
+        executor = ThreadPoolExecutor(max_workers=self.debater.num_agents + 1)
+
+        def process_solution(i, solution):
+            solution = self.correct_solution(i, solution)
+            return ranker.rank_single(solution) if solution is not None else {}
+
+        def process_answer(i, agent_context):
+            solution = self.debater.get_json_puzzle_solution(agent_context[-1]['content'])
+            return process_solution(i, solution)
+
+        def drive_debate():
+            if branch:
+                for i, solution in enumerate(branch.result()):
+                    executor.submit(process_solution, i, solution).add_done_callback(results.put)
+                return
+            for i, agent_context in self.debater.iter_agent_contexts():
+                if stop.is_set():
+                    return
+                executor.submit(process_answer, i, agent_context).add_done_callback(results.put)
+
+        debate_future = executor.submit(drive_debate)
+        debate_future.add_done_callback(results.put)
+
+        num_ranked = 0
+        try:
+            while num_ranked < self.debater.num_agents:
+                future = results.get()
+                try:
+                    if future is debate_future:
+                        future.result() # raises if the debate failed
+                        continue
+                    tally.add_solution(future.result())
+                except BudgetExceeded as e:
+                    print(f"{e}, submitting the best groups so far")
+                    break
+                num_ranked += 1
+
+                # submit groups that already have enough votes while the other agents are still being processed
+                while self.groups_correct < 4:
+                    self.ranked_groups = self.ret_unsubmitted_groups(tally)
+                    try:
+                        next_group = self.get_next_group()
+                    except ValueError:
+                        break
+                    # a local proposal alone never makes a majority, only the agents' votes count here
+                    if tally.agent_votes[tuple(sorted(next_group))] < self.min_votes:
+                        break
+                    if not self.submit_group(next_group, successful_groups):
+                        return successful_groups, next_group
+                if self.groups_correct >= 4:
+                    return successful_groups, None
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            # a round that ended early ranked only some agents, replaying that partial tally would skip the debate
+            if num_ranked == self.debater.num_agents:
+                self.memoize_ranking(tally.ranked_groups())
+
+        # all agents are ranked or the budget is spent, submit the remaining groups in order, then the best groups known before this round
+        groups_solved, failed_group = self.submit_best_so_far(self.ret_unsubmitted_groups(tally))
+        return successful_groups + groups_solved, failed_group
+
 
     def execute_group(self, group):
         # Returns boolean if group was successful
+        if self.oracle is not None:
+            return self.oracle(group)
         def get_result(group_words):
             print(group_words)
             user_input = input("Was it succeed, Y or N: ")
@@ -150,37 +622,144 @@ class Orchestrator:
 
 
 
+class VoteTally:
+    '''
+    Incrementally aggregates ranked solutions. Groups are sorted by the number of votes across solutions, ties broken by average rank.
+        Votes of seeded candidate groups count for the order only, agent_votes holds the votes of the agents' solutions
+    '''
+    def __init__(self):
+        self.num_votes = defaultdict(int) # key is tuple of group words (alpha sorted for order invariance)
+        self.agent_votes = defaultdict(int)
+        self.ranks = defaultdict(list)
+
+    def add_solution(self, ranked_solution):
+        '''
+        ranked_solution: Dict where key is the rank and value is the group of words
+        '''
+        for rank, group_words in ranked_solution.items():
+            self.add_group(group_words, int(rank))
+            self.agent_votes[tuple(sorted(group_words))] += 1
+
+    def add_group(self, group_words, rank: int, num_votes=1):
+        group_key = tuple(sorted(group_words))
+        self.ranks[group_key].append(rank)
+        self.num_votes[group_key] += num_votes
+
+    def ranked_groups(self):
+        group_items = [] #(group_list, num_votes, avg_rank)
+        for group_key, votes in self.num_votes.items():
+            group_items.append((list(group_key), votes, float(np.mean(self.ranks[group_key]))))
+
+        sorted_group_items = sorted(group_items, key=lambda x: (-x[1], x[2])) #sort first by num votes, then avg_rank
+        return [tup[0] for tup in sorted_group_items]
+
+
+class DebateCancelled(Exception):
+    pass
+
+
+class SpeculativeBranch:
+    '''
+    A debate for a possible next round that runs in the background
+    '''
+    def __init__(self, debater, future):
+        self.debater = debater
+        self.future = future
+
+    def result(self):
+        '''
+        Returns the list of agent solutions, waits if the debate is still running
+        '''
+        return self.future.result()
+
+    def cancel(self):
+        self.debater.cancel_event.set()
+        self.future.cancel()
+
+
+class Speculator:
+    '''
+    Starts the next round's debate for the failure of a submission while the game answers.
+        The branch is kept if the submission failed and cancelled otherwise. Calls made by cancelled branches
+        are charged to max_wasted_calls and no new branch is started once it could be exceeded
+    '''
+    def __init__(self, max_wasted_calls=30, max_workers=2):
+        self.max_wasted_calls = max_wasted_calls
+        self.wasted_calls = 0
+        self.branches = {} # key: state key, val: SpeculativeBranch
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def state_key(self, words, failed_groups):
+        return (tuple(sorted(words)), tuple(sorted(tuple(sorted(group)) for group in failed_groups)))
+
+    def start(self, words, failed_groups, debater):
+        '''
+        Starts debater for the state of words and failed groups, unless it is already running or the budget is spent
+        '''
+        key = self.state_key(words, failed_groups)
+        # at most one branch per submission is cancelled, so one full debate must still fit in the budget
+        max_calls = debater.num_agents * (debater.num_rounds + 1)
+        if key in self.branches or self.wasted_calls + max_calls > self.max_wasted_calls:
+            return
+        self.branches[key] = SpeculativeBranch(debater, self.executor.submit(debater.driver))
+
+    def resolve(self, words, failed_groups):
+        '''
+        Keeps the branch for the observed outcome and cancels the others. Every branch is cancelled when words is None
+        '''
+        keep_key = None if words is None else self.state_key(words, failed_groups)
+        for key in list(self.branches.keys()):
+            if key != keep_key:
+                self.cancel(key)
+
+    def cancel(self, key):
+        branch = self.branches.pop(key)
+        branch.cancel()
+        self.wasted_calls += branch.debater.num_calls
+        print(f"Cancelled speculative debate, wasted calls {self.wasted_calls}/{self.max_wasted_calls}")
+
+    def take(self, words, failed_groups):
+        '''
+        Returns the branch for the given state if one was started, otherwise None
+        '''
+        return self.branches.pop(self.state_key(words, failed_groups), None)
+
+    def close(self):
+        for key in list(self.branches.keys()):
+            self.cancel(key)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
 class Model:
-    def __init__(self, model_name:str, base_prompt='You are a helpful assistant.', history=None):
+    def __init__(self, model_name:str, base_prompt='You are a helpful assistant.', history=None, component='model', budget=None):
         self.model_name = model_name
+        self.component = component # key of the token budget used for this history
+        self.budget = budget # puzzle budget charged for every call
         if 'gpt' in model_name:
-            self.client = OpenAI()
+            self.client = get_client()
         assert 'gpt' in model_name
 
         if history:
-            self.history = history 
+            self.history = MessageChain.from_messages(history)
         else:
-            self.history = [{"role": "system", "content": base_prompt}]
+            self.history = MessageChain.from_messages([{"role": "system", "content": base_prompt}])
 
 
-    def forward(self, prompt=None, json_mode=False):
+    def forward(self, prompt=None, json_mode=False, stage=None):
         '''
         Calls model and returns output 
         '''
         if prompt:
-            self.history.append({"role": "user", "content": prompt})
+            self.history = self.history.append({"role": "user", "content": prompt})
         
+        stage = stage or self.component
         if json_mode:
-            completion = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=self.history,
-            response_format={ "type": "json_object" })
+            completion = create_completion(self.client, self.model_name, self.history, stage, self.component, budget=self.budget,
+                response_format={ "type": "json_object" })
         else:
-            completion = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=self.history)
+            completion = create_completion(self.client, self.model_name, self.history, stage, self.component, budget=self.budget)
         content = completion.choices[0].message.content
-        self.history.append({"role": "assistant", "content": content})
+        self.history = self.history.append({"role": "assistant", "content": content})
 
         return content 
 
@@ -188,26 +767,36 @@ class Ranker:
     '''
     Takes in a list of solutions and returns a list of solution where each solution has the groups ranked
     '''
-    def __init__(self, list_solutions):
+    def __init__(self, list_solutions, budget=None, cancel_event=None):
         '''
         list_solutions: List[Dict], Dict is {theme: group_words_list}
         '''
+        self.budget = budget
+        self.cancel_event = cancel_event # set to stop ranking before the next call
         system_prompt = "You are an expert NYT Connections solver. You will be given some candidate solution of categories and their groups of words. Please rank the groups by your confidence on the correctness of the group, with 1 being the most confident."
         self.list_solutions = list_solutions
-        self.model = Model("gpt-4o", system_prompt)
+        self.ranked_solutions = []
+        self.model = Model(router.model('ranker'), system_prompt, component='ranker', budget=budget)
+        self.base_history = self.model.history
     
-    def rank_solution(self, solution):
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise DebateCancelled("Ranking was cancelled")
+
+    def rank_solution(self, solution, model=None):
         '''
         Ranks solution and returns a string with ranked groups in content 
 
         solution: Dict (key: group theme, val: List[str])
         '''
+        self.check_cancelled()
+        model = model or self.model
         prompt = f"Solution: {solution}"
-        response = self.model.forward(prompt)
+        response = model.forward(prompt, stage='rank')
 
         return response 
 
-    def shape_json(self):
+    def shape_json(self, model=None):
         '''
         Takes string from rank_solution and returns Dict where key is the rank (confidence rank, 1 highest) and value is a (key: group theme, group_words: List[str])
         '''
@@ -215,22 +804,67 @@ class Ranker:
         You are to return a JSON object where the key is the rank [1-4] and the value is the corresponding group of words.
         
         Example: {{1: ["CAMPAIGN", "CANVASS", "ORGANIZE", "STUMP"], 2: ["COMPOSITION", "FABRIC", "MAKEUP", "STRUCTURE"], 3:["CLAMP", "FILE", "LEVEL", "SAW"], 4:["LOG", "MAX", "MOD", "TAN"]}}'''
-        json_response = self.model.forward(prompt, json_mode=True)
+        self.check_cancelled()
+        model = model or self.model
+        json_response = model.forward(prompt, json_mode=True, stage='rank json')
         ranked_solution = json.loads(json_response)
         return ranked_solution 
 
+    def rank_single(self, solution):
+        '''
+        Ranks one solution in its own fork of the ranker history, so solutions can be ranked concurrently
+        '''
+        model = Model(router.model('ranker'), history=self.base_history, component='ranker', budget=self.budget)
+        return self.rank_with_escalation(solution, model)
+
+    def is_ranking_valid(self, solution, ranked_solution):
+        # the ranks must be 1 to the number of groups and rank exactly the groups of the solution
+        if sorted(str(rank) for rank in ranked_solution) != [str(rank) for rank in range(1, len(solution) + 1)]:
+            return False
+        try:
+            ranked_keys = set(tuple(sorted(group_words)) for group_words in ranked_solution.values())
+        except TypeError:
+            return False
+        return ranked_keys == set(tuple(sorted(group_words)) for group_words in solution.values())
+
+    def rank_with_escalation(self, solution, model):
+        '''
+        Ranks solution with model and reranks it in a fork on the next ranker model while the ranking is not valid
+        '''
+        level = 0
+        while True:
+            _ = self.rank_solution(solution, model)
+            ranked_solution = self.shape_json(model)
+            if not router.should_escalate('ranker', level, not self.is_ranking_valid(solution, ranked_solution),
+                                          "ranking does not match the solution groups"):
+                return ranked_solution
+            level += 1
+            model = Model(router.model('ranker', level), history=self.base_history, component='ranker', budget=self.budget)
+
 
     def rank_solutions(self):
         '''
         Returns a list of dictionaries where the key is the confidence rank and the val is the group of words 
         '''
-        ranked_solutions = []
+        self.ranked_solutions = [] # kept on the ranker so a ranking cut short by the budget is not lost
         for i in range(0, len(self.list_solutions)):
             sol = self.list_solutions[i]
-            _ = self.rank_solution(sol)
-            ranked_solutions.append(self.shape_json())
+            self.ranked_solutions.append(self.rank_with_escalation(sol, self.model))
 
-        return ranked_solutions
+        return self.ranked_solutions
+
+    def rank_concurrently(self):
+        '''
+        Same as rank_solutions but ranks every solution at once with rank_single, so a batch of requests ranks
+            all the solutions in two round trips
+        '''
+        self.ranked_solutions = []
+        with ThreadPoolExecutor(max_workers=max(1, len(self.list_solutions))) as executor:
+            futures = [executor.submit(self.rank_single, sol) for sol in self.list_solutions]
+            for future in futures:
+                self.ranked_solutions.append(future.result()) # raises BudgetExceeded, the solutions ranked before it are kept
+
+        return self.ranked_solutions
 
 
 class Verifier:
@@ -264,23 +898,27 @@ class Verifier:
         # check number of groups
         if len(list(solution.values())) != len(self.available_words) // 4:
             print("Incorrect number of groups")
+            metrics.verifier_failures.inc('wrong group count')
             return False, f"The solution you returned has an incorrect number of groups. The remaining words {self.available_words} has {len(self.available_words)} words and so should have {len(self.available_words)//4} groups. Please reflect on this and create a new solution."
         # check number of words 
         for group in list(solution.values()):
             if len(group) != 4:
                 print("Incorrect number of words in a group")
+                metrics.verifier_failures.inc('wrong group size')
                 return False, f"The solution must return groups of four words. Your solution contains a group {group} with {len(group)} words. Please reflect and create a new solution."
         #check if words come from available words
         for group in list(solution.values()):
             for word in group:
                 if word not in self.available_words:
                     print("Incorrect words chosen")
+                    metrics.verifier_failures.inc('unknown word')
                     return False, f"The solution must return groups of four words that come from the set of available words {self.available_words}. Your solution contains a group {group} with a word that is not in the set of available words. Please reflect and create a new solution."
         #check if no groups share a word
         list_group_sets = [set(group) for group in list(solution.values())]
         all_disjoint = self.check_disjoint_sets(list_group_sets)
         if not all_disjoint:
             print(f"Groups {list_group_sets} are not disjoint")
+            metrics.verifier_failures.inc('overlap')
             return False, f"The solution must use the available words and partition them into groups of four words that do not share a word with any other group. Your solution has groups that share words. Please reflect on this and create a new solution."
 
         return True, ""
@@ -308,6 +946,45 @@ class Verifier:
 
 
 
+class GroupStreamParser:
+    '''
+    Parses lines of the form **group name**: [word_one, word_two, word_three, word_four] from a streamed response
+        as soon as each line is complete
+    '''
+    group_pattern = re.compile(r"\*\*(.+?)\*\*\s*:\s*\[([^\]\n]*)\]")
+
+    def __init__(self, available_words: list[str]):
+        self.available_words = set(available_words)
+        self.num_groups = len(available_words) // 4
+        self.pos = 0 # end of the last parsed group line
+        self.groups = [] # list of (theme, group words) with four available words, in order of appearance
+
+    def feed(self, content: str):
+        '''
+        Parses the new complete group lines of the streamed content so far. Returns the number of new valid groups
+        '''
+        num_new = 0
+        for match in self.group_pattern.finditer(content, self.pos):
+            self.pos = match.end()
+            group_words = [word.strip(" '\"").upper() for word in match.group(2).split(",")]
+            if len(group_words) == 4 and all(word in self.available_words for word in group_words):
+                self.groups.append((match.group(1).strip(), group_words))
+                num_new += 1
+        return num_new
+
+    def is_complete(self):
+        # walking back from the latest group, later groups replace earlier ones they overlap with
+        if self.num_groups == 0:
+            return False
+        used_words = set()
+        num_disjoint = 0
+        for _, group_words in reversed(self.groups):
+            if used_words.isdisjoint(group_words):
+                used_words.update(group_words)
+                num_disjoint += 1
+        return num_disjoint == self.num_groups
+
+
 '''
 Some notes from the debate paper: https://openreview.net/pdf?id=zj7YuTE4t8#page=12&zoom=100,409,81
     - Add a longer debate prompt
@@ -321,26 +998,76 @@ class Debate:
     Conducts a debate and returns a list of dictionaries which each hold groups of size 4 and their themes based on the current
         available words
     '''
-    def __init__(self, available_words: list[str], num_rounds:int, num_agents:int):
+    def __init__(self, available_words: list[str], num_rounds:int, num_agents:int, cancel_event=None, stream=False, stop_early=False,
+                 candidate_groups=None, level=0, budget=None):
         self.available_words = available_words
         self.num_rounds = num_rounds
         self.num_agents = num_agents
-        self.client = OpenAI()
+        self.client = get_client()
         self.agent_contexts = []
         self.failed_groups = [] #list of group words that failed
+        self.cancel_event = cancel_event # set to stop a speculative debate before its next call
+        self.num_calls = 0
+        self.stream = stream # stream completions and parse group lines as they appear
+        self.stop_early = stop_early # end a streamed response once it contains a full valid set of groups
+        self.candidate_groups = candidate_groups or [] # {category: [group_words]} proposed by local stages, given to the agents as hints
+        self.level = level # level of the debate model in the cascade
+        self.budget = budget
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise DebateCancelled("Speculative debate was cancelled")
+        self.num_calls += 1
 
     def update_failed_groups(self, failed_groups):
         self.failed_groups = failed_groups
 
-    def construct_assistant_msg(self, completion):
-        content = completion.choices[0].message.content
+    def construct_assistant_msg(self, content):
         return {"role": "assistant", "content": content}
     
-    def generate_answer(self, answer_context):
-        completion = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=answer_context)
-        return completion
+    def generate_answer(self, answer_context, stage='debate'):
+        '''
+        Returns the content of the agent's answer
+        '''
+        self.check_cancelled()
+        if self.stream:
+            return self.generate_streamed_answer(answer_context, stage)
+        completion = create_completion(self.client, router.model('debate', self.level), answer_context, stage, 'debate', budget=self.budget)
+        return completion.choices[0].message.content
+
+    def generate_streamed_answer(self, answer_context, stage):
+        '''
+        Streams the answer and parses its group lines as they arrive. Records the time to the first group and,
+            if self.stop_early, stops reading once the answer holds a complete valid set of groups
+        '''
+        start = time.time()
+        parser = GroupStreamParser(self.available_words)
+        stats = {'stage': stage, 'time_to_first_group': None, 'stopped_early': False}
+        content = ''
+        model_name = router.model('debate', self.level)
+        stream = create_completion(self.client, model_name, answer_context, stage, 'debate', budget=self.budget, stream=True)
+        try:
+            for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                content += chunk.choices[0].delta.content
+                if parser.feed(content) and stats['time_to_first_group'] is None:
+                    stats['time_to_first_group'] = time.time() - start
+                if self.stop_early and parser.is_complete():
+                    stats['stopped_early'] = True
+                    break
+        finally:
+            stream.close()
+
+        stats['total_time'] = time.time() - start
+        profiler.record_stream(stats['time_to_first_group'], stats['stopped_early'])
+        if stats['time_to_first_group'] is not None:
+            metrics.debate_first_group.observe(model_name, value=stats['time_to_first_group'])
+        completion_tokens = count_tokens(content, model_name) # streams carry no usage, the text that was read is counted
+        record_response(model_name, stage, 'debate', stats['total_time'], completion_tokens)
+        if self.budget is not None:
+            self.budget.add_tokens(completion_tokens)
+        return content
 
     def construct_message(self, agent_contexts_other, question, idx):
         '''
@@ -362,7 +1089,10 @@ class Debate:
         return {"role": "user", "content": prefix_string}
                     
 
-    def ret_agent_contexts(self): 
+    def ret_prompts(self):
+        '''
+        Returns (system prompt, question) for the current available words and failed groups
+        '''
         if len(self.available_words) == 16:
             system_prompt = """You are a NYT Connections solver. As a reminder,
             The NYT Connections game is a word puzzle where players are given a grid of 16 words and must categorize them into four groups of four words each.
@@ -399,26 +1129,81 @@ class Debate:
             "groups you have created, putting your answer in the form "
             "**group name**: [word_one, word_two, word_three, word_four]"
         )        
-  
-        agent_contexts = [[
+        if self.candidate_groups:
+            question += (
+            f" Local word similarity and wordplay models proposed these candidate groups, which may be wrong or red herrings: {self.candidate_groups}."
+            )
+        return system_prompt, question
+
+    def agent_turn(self, agent_contexts, i, round, question):
+        '''
+        Runs debate round for agent i and returns its new context. Only reads the answers of the previous round,
+            so the agents of a round can run concurrently
+        '''
+        agent_context = agent_contexts[i]
+        if round > 0:
+            agent_contexts_other = agent_contexts[:i] + agent_contexts[i+1:]
+            message = self.construct_message(agent_contexts_other, question, 2*round)
+            agent_context = agent_context.append(message)
+        
+        content = self.generate_answer(agent_context, stage=f'debate round {round + 1}')
+        assistant_msg = self.construct_assistant_msg(content)
+        #TODO: send generation content to backend to show on webapp
+        #print(f'Round {round + 1} Agent {i + 1}')
+        print(f'Round {round + 1} Agent {i + 1}: {assistant_msg['content']}')
+        return agent_context.append(assistant_msg)
+
+    def iter_agent_contexts(self):
+        '''
+        Runs the debate with the agents of each round in parallel. Yields (agent idx, agent context) as soon as
+            each agent has given its final answer
+        '''
+        system_prompt, question = self.ret_prompts()
+        # every agent starts from the same shared prompt prefix
+        base_context = MessageChain.from_messages([
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": question}] for _ in range(self.num_agents)]
-
-        for round in range(self.num_rounds):
-            for i, agent_context in enumerate(agent_contexts):
-                if round > 0:
-                    agent_contexts_other = agent_contexts[:i] + agent_contexts[i+1:]
-                    message = self.construct_message(agent_contexts_other, question, 2*round)
-                    agent_context.append(message)
-                
-                completion = self.generate_answer(agent_context)
-                assistant_msg = self.construct_assistant_msg(completion)
-                agent_context.append(assistant_msg)
-                #TODO: send generation content to backend to show on webapp
-                #print(f'Round {round + 1} Agent {i + 1}')
-                print(f'Round {round + 1} Agent {i + 1}: {assistant_msg['content']}')
-
-        return agent_contexts
+                {"role": "user", "content": question}])
+        agent_contexts = [base_context for _ in range(self.num_agents)]
+        self.agent_contexts = list(agent_contexts)
+
+        with ThreadPoolExecutor(max_workers=self.num_agents) as executor:
+            for round in range(self.num_rounds - 1):
+                futures = [executor.submit(self.agent_turn, agent_contexts, i, round, question) for i in range(self.num_agents)]
+                # answers that finished are kept even if another agent of the round failed
+                for i, future in enumerate(futures):
+                    if future.exception() is None:
+                        self.agent_contexts[i] = future.result()
+                agent_contexts = [future.result() for future in futures]
+
+            self.agent_contexts = list(agent_contexts)
+            futures = {executor.submit(self.agent_turn, agent_contexts, i, self.num_rounds - 1, question): i for i in range(self.num_agents)}
+            for future in as_completed(futures):
+                i = futures[future]
+                self.agent_contexts[i] = future.result()
+                yield i, self.agent_contexts[i]
+
+    def ret_agent_contexts(self): 
+        for _ in self.iter_agent_contexts():
+            pass
+        return self.agent_contexts
+
+    def is_extraction_valid(self, response: str, response_msg: str):
+        '''
+        Returns True if the extraction of response is a json object of four word groups of board words with as many
+            groups as the board has, or as the response lists when it gives fewer
+        '''
+        try:
+            solution = json.loads(response_msg)
+        except json.JSONDecodeError:
+            return False
+        parser = GroupStreamParser(self.available_words)
+        parser.feed(response)
+        num_groups = len(self.available_words) // 4
+        if parser.groups:
+            num_groups = min(num_groups, len(parser.groups)) # an agent that gave fewer groups is corrected by the verifier, not escalated here
+        if not isinstance(solution, dict) or len(solution) != num_groups:
+            return False
+        return all(isinstance(group, list) and len(group) == 4 and all(word in self.available_words for word in group) for group in solution.values())
 
     def get_json_puzzle_solution(self, response: str):
         system_prompt = (
@@ -439,12 +1224,17 @@ class Debate:
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
             ]
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=history,
-            response_format={ "type": "json_object" },
-        )
-        response_msg = response.choices[0].message.content
+        # escalates when the extraction is not a full set of four word groups of board words
+        level = 0
+        while True:
+            self.check_cancelled()
+            completion = create_completion(self.client, router.model('extract', level), history, 'extract', 'extract', budget=self.budget,
+                response_format={ "type": "json_object" },
+            )
+            response_msg = completion.choices[0].message.content
+            if not router.should_escalate('extract', level, not self.is_extraction_valid(response, response_msg), "extraction is not a full set of board groups"):
+                break
+            level += 1
         response = json.loads(response_msg)
         return response 
 
@@ -470,15 +1260,16 @@ class Debate:
 
 #TODO: use different model types 
 class Jury:
-    def __init__(self, num_judges=3):
+    def __init__(self, num_judges=3, budget=None):
         self.num_judges = num_judges
+        self.budget = budget
 
-    def judge(self, plan):
+    def judge(self, plan, level=0):
         '''
         Given a plan, return a List of Bools on whether the corresponding group makes sense
         plan: List[{category: group words}]
         '''
-        client = OpenAI()
+        client = get_client()
         #TODO: add some incontext examples
         system_prompt = (
             "You are a judge evaluating a solution to the NYT Connections game, a game that requires the player "
@@ -493,9 +1284,7 @@ class Jury:
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
             ]
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=history,
+        response = create_completion(client, router.model('jury', level), history, 'judge', 'jury', budget=self.budget,
             response_format={ "type": "json_object" },
         )
         response_msg = response.choices[0].message.content
@@ -515,7 +1304,7 @@ class Jury:
         
         return num_true >= math.ceil(len(list_bools)/2)
 
-    def group_votes(self, plan):
+    def group_votes(self, plan, level=0):
         '''
         Returns a dictionary with key: index of the group element
             and val as the list of booleans representing the judges votes
@@ -523,11 +1312,14 @@ class Jury:
         total_votes = defaultdict(list) #key: index   val: [bools]
 
         for _ in range(self.num_judges):
-            valid_bools = self.judge(plan) # list of bools 
+            valid_bools = self.judge(plan, level) # list of bools 
             for i in range(0, len(valid_bools)):
                 total_votes[i].append(valid_bools[i])
         return total_votes
 
+    def is_split(self, total_votes_dict):
+        return any(len(set(votes)) > 1 for votes in total_votes_dict.values())
+
     def get_final_vote(self, total_votes_dict):
         '''
         Returns a dictionary with key: index of the group element
@@ -542,7 +1334,14 @@ class Jury:
         '''
         Returns a list of is_valid bool coresponding to whether the plan element (i.e group) is valid
         '''
-        jury_votes = self.group_votes(plan)
+        level = 0
+        jury_votes = self.group_votes(plan, level)
+        # the judges vote again on a stronger model when they disagree on a group
+        while router.should_escalate('jury', level, self.is_split(jury_votes), "jury vote is split"):
+            level += 1
+            jury_votes = self.group_votes(plan, level)
+        for votes in jury_votes.values():
+            metrics.jury_agreement.observe(value=max(votes.count(True), votes.count(False)) / len(votes))
         vote_dict = self.get_final_vote(jury_votes)
         is_valid = []
         for i in range(0, len(list(vote_dict.items()))):
@@ -552,32 +1351,34 @@ class Jury:
 
 
 class GPT:
-    def __init__(self, user_prompt, system_prompt, failed_plans, model_type='gpt-4o'):
+    def __init__(self, user_prompt, system_prompt, failed_plans, model_type=None, stage='plan', budget=None, max_retries=3):
         self.user_prompt = user_prompt
         self.system_prompt = system_prompt
         self.failed_plans = failed_plans
         if self.failed_plans:
-            self.history = [
+            self.history = MessageChain.from_messages([
                     {"role": "system", "content": system_prompt},
                     {"role": "system", "content": f'Previous failed list of groups: """{failed_plans}"""'},
                     {"role": "user", "content": user_prompt}
-            ]
+            ])
         else:
-            self.history = [
+            self.history = MessageChain.from_messages([
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": user_prompt}
-            ]
-        self.client = OpenAI()
-        self.model_type = model_type
+            ])
+        self.client = get_client()
+        self.model_type = model_type # fixed model, the 'gpt' cascade is used when None
+        self.level = 0
+        self.stage = stage
+        self.budget = budget
+        self.max_retries = max_retries # invalid plans regenerated before giving up
     
     def return_json(self):
-        response = self.client.chat.completions.create(
-            model=self.model_type,
-            messages=self.history,
+        response = create_completion(self.client, self.model_type or router.model('gpt', self.level), self.history, self.stage, 'gpt', budget=self.budget,
             response_format={ "type": "json_object" },
         )
         response_msg = response.choices[0].message.content
-        self.history.append({"role": "assistant", "content": response_msg})
+        self.history = self.history.append({"role": "assistant", "content": response_msg})
         response_json = json.loads(response_msg)
         return response_json
     
@@ -627,15 +1428,22 @@ class GPT:
 
     def forward(self, board_words):
         '''
-        Generates responses until you get a valid response. Returns plan which is a list of [{category: [group_words]]
+        Generates responses until you get a valid response. Returns plan which is a list of [{category: [group_words]].
+            Raises ValueError after self.max_retries invalid responses
         '''
         is_valid = False
+        num_invalid = 0
         while (not is_valid):
+            if num_invalid > self.max_retries:
+                raise ValueError(f"GPT returned {num_invalid} invalid responses")
             output = self.return_json()
             is_valid = self.check_valid_json(output, board_words)
+            if self.model_type is None and router.should_escalate('gpt', self.level, not is_valid, "invalid plan"):
+                self.level += 1
 
             if not is_valid:
-                self.history.append({"role": "user", "content": incorrect_json_str})
+                num_invalid += 1
+                self.history = self.history.append({"role": "user", "content": incorrect_json_str})
                 print(f"GPT returned an invalid response.\n")
                 print()
             
@@ -644,12 +1452,14 @@ class GPT:
 
 class Replanner:
     # generates one plan that is validated as correct
-    def __init__(self, all_words: list[str]) -> None:
+    def __init__(self, all_words: list[str], budget=None, max_plans=5) -> None:
         self.all_words = all_words #all words remaining on the board 
+        self.budget = budget
+        self.max_plans = max_plans # plans generated before driver gives up
         self.jury_failed_groups = [] # list of voted failed {category: [group_words] } groups  
         self.failed_groups = [] # list of env failed {category: [group_words] }
         self.failed_plans = [] #list of failed plans [{category: [group_words] }]
-        self.jury = Jury()
+        self.jury = Jury(budget=budget)
     
     def update_jury_failed_groups(self, plan, is_valid_arr):
         for i in range(0, len(is_valid_arr)):
@@ -677,7 +1487,7 @@ class Replanner:
         '''
         user_prompt = f'Use these set of words to generate groups of four from: """{self.all_words}"""'
         
-        gpt_gen = GPT(user_prompt, plan_generator_system_prompt, self.failed_plans)
+        gpt_gen = GPT(user_prompt, plan_generator_system_prompt, self.failed_plans, budget=self.budget)
         plan = gpt_gen.forward(self.all_words)
         print(f"Generated Plan: {plan}\n")
         
@@ -720,7 +1530,7 @@ class Replanner:
             Returns None if not all of the groups make sense, otherwise returns the plan which is list [{category: [group_words] }] of remaining words
         '''
         user_prompt = f'Set of words to generate groups of four from: """{remaining_words}"""'
-        gpt_gen = GPT(user_prompt, replan_generator_system_prompt, self.failed_plans)
+        gpt_gen = GPT(user_prompt, replan_generator_system_prompt, self.failed_plans, stage='replan', budget=self.budget)
         plan = gpt_gen.forward(remaining_words)
         print(f"Words: {remaining_words}\n Regenerated Plan: {plan}\n")
       
@@ -734,10 +1544,22 @@ class Replanner:
         return plan 
        
     def driver(self):
+        '''
+        Generates plans until the jury accepts one. Returns the plan, or None after self.max_plans rejected or
+            invalid plans or once the budget is spent
+        '''
         generated_result = None
-        while(generated_result is None):
+        num_plans = 0
+        while(generated_result is None and num_plans < self.max_plans):
             print("Generating a new plan")
-            generated_result = self.generate_plan()
+            num_plans += 1
+            try:
+                generated_result = self.generate_plan()
+            except BudgetExceeded as e:
+                print(f"{e}, no plan was accepted")
+                break
+            except ValueError as e: # GPT gave no valid plan or a judge gave no valid verdict
+                print(f"Plan rejected: {e}")
         
         # try out the given plan 
         # TODO: rank the elements in the given plan or use the votes by the jury to decide which one to try out first
@@ -0,0 +1,120 @@
+'''
+Record and replay of LLM exchanges with their observed latency, to benchmark scheduling changes offline
+    with realistic timing and the same outputs on every run
+'''
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+from batch import to_response
+
+
+def request_key(body: dict):
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+
+class RecordedStream:
+    '''
+    Wraps a streamed response and records every chunk with its offset from the request. The recording is
+        written when the stream is exhausted or closed, so a stream that was cut early is replayed cut as well
+    '''
+    def __init__(self, stream, recorder, entry, start):
+        self.stream = stream
+        self.recorder = recorder
+        self.entry = entry
+        self.start = start
+        self.is_written = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.stream:
+                self.entry['chunks'].append({"offset": time.perf_counter() - self.start, "body": chunk.model_dump()})
+                yield chunk
+        finally:
+            self.write()
+
+    def close(self):
+        if hasattr(self.stream, 'close'):
+            self.stream.close()
+        self.write()
+
+    def write(self):
+        if self.is_written:
+            return
+        self.is_written = True
+        self.entry['latency'] = time.perf_counter() - self.start
+        self.recorder.write(self.entry)
+
+
+class RecordingClient:
+    '''
+    Drop in for the OpenAI client that forwards every request and appends the exchange, its latency and token counts
+        to a JSONL file
+    '''
+    def __init__(self, client, path: str):
+        self.client = client
+        self.path = path
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def write(self, entry):
+        with self.lock, open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def create(self, model, messages, **kwargs):
+        body = {"model": model, "messages": list(messages), **kwargs}
+        entry = {"key": request_key(body), "model": model}
+        start = time.perf_counter()
+        response = self.client.chat.completions.create(model=model, messages=messages, **kwargs)
+        if kwargs.get('stream'):
+            entry['chunks'] = []
+            return RecordedStream(response, self, entry, start)
+
+        entry['latency'] = time.perf_counter() - start
+        entry['body'] = response.model_dump()
+        usage = entry['body'].get('usage') or {}
+        entry['prompt_tokens'] = usage.get('prompt_tokens')
+        entry['completion_tokens'] = usage.get('completion_tokens')
+        self.write(entry)
+        return response
+
+
+class ReplayClient:
+    '''
+    Drop in for the OpenAI client that answers from a recording. Identical requests are answered in the order they
+        were recorded. Each answer is delayed by its recorded latency times latency_scale, streamed chunks by their offsets
+    '''
+    def __init__(self, path: str, latency_scale=1.0):
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.entries = defaultdict(deque) # key: request key, val: recorded entries in order
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError: # last line of a recording that was killed mid write
+                    continue
+                self.entries[entry['key']].append(entry)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, **kwargs):
+        key = request_key({"model": model, "messages": list(messages), **kwargs})
+        with self.lock:
+            if not self.entries[key]:
+                raise LookupError(f"No recorded response left for a {model} request {key[:12]}")
+            entry = self.entries[key].popleft()
+
+        if 'chunks' in entry:
+            return self.replay_stream(entry['chunks'])
+        time.sleep(entry['latency'] * self.latency_scale)
+        return to_response(entry['body'])
+
+    def replay_stream(self, chunks):
+        start = time.perf_counter()
+        for chunk in chunks:
+            delay = chunk['offset'] * self.latency_scale - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            yield to_response(chunk['body'])
@@ -0,0 +1,253 @@
+'''
+Asyncio service that hosts many concurrent games in one process over a small HTTP/JSON API
+
+    POST   /sessions                 {"words": [16 words]} -> starts a game, returns its session_id
+    GET    /sessions/<id>/next       waits for the next group to submit, or the final result once the game is over
+    POST   /sessions/<id>/outcome    {"correct": true/false} -> answers the pending group
+    GET    /sessions/<id>            state of the game
+    DELETE /sessions/<id>            ends the game
+    GET    /metrics                  metrics of every game in the Prometheus text format
+'''
+import asyncio
+import json
+import os
+import queue
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from main import Engine
+from wordplay import WordplayDetector
+from group_index import GroupIndex
+from board_memo import BoardMemo
+from budget import Budget
+import metrics
+
+REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found', 409: 'Conflict', 503: 'Service Unavailable'}
+
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class SessionAborted(Exception):
+    pass
+
+
+class Session:
+    '''
+    State of one game. The Engine runs in a worker thread and blocks in oracle until the client posts the outcome
+        of the group it submitted. Everything else (remaining words, failed groups, mistakes) lives in the Engine
+    '''
+    __slots__ = ('session_id', 'loop', 'engine', 'outcomes', 'ready', 'pending_group', 'result', 'last_active')
+
+    def __init__(self, session_id, loop):
+        self.session_id = session_id
+        self.loop = loop
+        self.engine = None
+        self.outcomes = queue.Queue() # outcomes posted by the client, None aborts the game
+        self.ready = asyncio.Event() # set while a group is pending or the game is over
+        self.pending_group = None
+        self.result = None
+        self.last_active = time.monotonic()
+
+    def oracle(self, group):
+        # runs in the engine thread
+        self.loop.call_soon_threadsafe(self.propose, group)
+        correct = self.outcomes.get()
+        if correct is None:
+            raise SessionAborted(self.session_id)
+        return correct
+
+    def propose(self, group):
+        self.pending_group = list(group)
+        self.ready.set()
+
+    def finish(self, result):
+        self.pending_group = None
+        self.result = result
+        self.ready.set()
+
+    def answer(self, correct: bool):
+        if self.pending_group is None:
+            raise ServiceError(409, "No group is waiting for an outcome")
+        self.pending_group = None
+        self.ready.clear()
+        self.outcomes.put(correct)
+
+    def status(self):
+        engine = self.engine
+        return {
+            "session_id": self.session_id,
+            "remaining_words": list(engine.remaining_words),
+            "failed_groups": list(engine.failed_groups),
+            "groups_correct": engine.groups_correct,
+            "num_mistakes": engine.num_mistakes,
+            "pending_group": self.pending_group,
+            "done": self.result is not None,
+            "result": self.result,
+        }
+
+
+class SolverService:
+    '''
+    Runs each game's Engine in its own worker thread. The OpenAI client and the local stages in engine_kwargs
+        (wordplay detector, group index, board memo, candidate generator) are shared by every session, each session
+        gets its own budget with budget_limits (max_calls, max_tokens, max_seconds)
+    '''
+    def __init__(self, engine_kwargs=None, max_sessions=200, session_timeout=600, budget_limits=None):
+        self.engine_kwargs = engine_kwargs or {}
+        self.budget_limits = budget_limits or {}
+        self.max_sessions = max_sessions
+        self.session_timeout = session_timeout # seconds without a client request before a session is dropped
+        self.sessions = {} # key: session_id, val: Session
+        self.executor = ThreadPoolExecutor(max_workers=max_sessions)
+
+    def start_session(self, words: list[str]):
+        if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+            raise ServiceError(400, "words must be a list of 16 distinct words")
+        words = [word.upper() for word in words]
+        if len(words) != 16 or len(set(words)) != 16:
+            raise ServiceError(400, "words must be a list of 16 distinct words")
+        if self.num_active_sessions() >= self.max_sessions:
+            raise ServiceError(503, "Too many sessions")
+
+        session = Session(uuid.uuid4().hex, asyncio.get_running_loop())
+        session.engine = Engine(words, oracle=session.oracle,
+                                budget=Budget(**self.budget_limits), **self.engine_kwargs)
+        self.sessions[session.session_id] = session
+        self.executor.submit(self.run_game, session)
+        return session
+
+    def num_active_sessions(self):
+        # finished sessions only hold their result until it is read or they go idle, so they don't take a slot
+        return sum(session.result is None for session in self.sessions.values())
+
+    def run_game(self, session):
+        # runs in a worker thread
+        engine = session.engine
+        try:
+            engine.main()
+            result = {"solved": engine.groups_correct == 4, "groups_correct": engine.groups_correct, "num_mistakes": engine.num_mistakes,
+                      "limit_hit": engine.budget.limit_hit}
+        except SessionAborted:
+            result = {"aborted": True}
+        except Exception as e:
+            result = {"error": repr(e)}
+        finally:
+            if engine.speculator:
+                engine.speculator.close()
+        session.loop.call_soon_threadsafe(session.finish, result)
+
+    def get_session(self, session_id):
+        if session_id not in self.sessions:
+            raise ServiceError(404, f"Unknown session {session_id}")
+        session = self.sessions[session_id]
+        session.last_active = time.monotonic()
+        return session
+
+    def end_session(self, session_id):
+        session = self.sessions.pop(session_id)
+        if session.result is None:
+            session.outcomes.put(None)
+
+    async def next_group(self, session):
+        await session.ready.wait()
+        session.last_active = time.monotonic()
+        if session.result is not None:
+            return {"done": True, "result": session.result}
+        return {"done": False, "group": session.pending_group}
+
+    async def route(self, method, path, body):
+        '''
+        Returns (status, response dict) of a request
+        '''
+        if not isinstance(body, dict):
+            raise ServiceError(400, "Request body must be a JSON object")
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        if parts == ['sessions'] and method == 'POST':
+            session = self.start_session(body.get('words'))
+            return 201, {"session_id": session.session_id}
+        if len(parts) < 2 or parts[0] != 'sessions':
+            raise ServiceError(404, f"Unknown path {path}")
+
+        session = self.get_session(parts[1])
+        if len(parts) == 2 and method == 'GET':
+            return 200, session.status()
+        if len(parts) == 2 and method == 'DELETE':
+            self.end_session(session.session_id)
+            return 200, {"session_id": session.session_id, "deleted": True}
+        if parts[2:] == ['next'] and method == 'GET':
+            return 200, await self.next_group(session)
+        if parts[2:] == ['outcome'] and method == 'POST':
+            if not isinstance(body.get('correct'), bool):
+                raise ServiceError(400, "correct must be true or false")
+            session.answer(body['correct'])
+            return 200, {"session_id": session.session_id, "accepted": True}
+        raise ServiceError(404, f"Unknown path {method} {path}")
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, path, _ = request_line.decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode().split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            if method == 'GET' and path.split('?')[0] == '/metrics':
+                status, response = 200, metrics.registry.render()
+            else:
+                status, response = await self.route(method, path, json.loads(body) if body else {})
+        except ServiceError as e:
+            status, response = e.status, {"error": str(e)}
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, response = 400, {"error": f"Bad request: {e}"}
+
+        if isinstance(response, str):
+            payload, content_type = response.encode(), 'text/plain; version=0.0.4'
+        else:
+            payload, content_type = json.dumps(response).encode(), 'application/json'
+        writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def drop_idle_sessions(self):
+        # finished or abandoned sessions are dropped so memory stays flat
+        while True:
+            await asyncio.sleep(min(self.session_timeout, 60))
+            now = time.monotonic()
+            for session_id, session in list(self.sessions.items()):
+                if now - session.last_active > self.session_timeout:
+                    print(f"Dropping idle session {session_id}")
+                    self.end_session(session_id)
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving games on http://{host}:{port}")
+        reaper = asyncio.create_task(self.drop_idle_sessions())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            reaper.cancel()
+            for session_id in list(self.sessions.keys()):
+                self.end_session(session_id)
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    engine_kwargs = {
+        "wordplay_detector": WordplayDetector(),
+        "group_index": GroupIndex(os.environ.get('GROUP_INDEX_PATH', 'group_index.db')),
+        "board_memo": BoardMemo(os.environ.get('BOARD_MEMO_PATH', 'board_memo.db')),
+    }
+    service = SolverService(engine_kwargs, max_sessions=int(os.environ.get('MAX_SESSIONS', 200)))
+    asyncio.run(service.serve(os.environ.get('SERVICE_HOST', '127.0.0.1'), int(os.environ.get('SERVICE_PORT', 8080))))
@@ -1,4 +1,21 @@
-from model import Jury, Debate
+from model import Jury, Debate, GroupStreamParser, VoteTally, Speculator
+from history import MessageChain
+from tokens import ContextGuard, count_message_tokens
+from wordplay import WordplayDetector
+from group_index import GroupIndex
+from board_memo import BoardMemo
+from budget import Budget, BudgetExceeded
+from service import SolverService, ServiceError
+from cascade import ModelRouter
+from batch import BatchClient, to_response
+from replay import RecordingClient, ReplayClient
+from metrics import MetricsRegistry, Counter, Histogram
+import json
+import asyncio
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
 import pdb 
 
 def test_jury():
@@ -11,6 +28,264 @@ def test_debate():
     debater = Debate(words, num_rounds=2, num_agents=3)
     pdb.set_trace()
     agent_contexts = debater.driver()
+
+def test_context_guard_fits_without_mutating():
+    messages = [{"role": "system", "content": "You solve puzzles."}, {"role": "user", "content": "question"}]
+    for i in range(40):
+        messages.append({"role": "assistant", "content": f"answer {i} " * 50})
+        messages.append({"role": "user", "content": "try again"})
+    original = [dict(message) for message in messages]
+    guard = ContextGuard({'debate': 500})
+    fitted, num_tokens, num_trimmed = guard.fit(messages, 'debate')
+    assert messages == original
+    assert num_tokens <= 500 and num_tokens == count_message_tokens(fitted) and num_trimmed > 0
+    assert fitted[0] == messages[0] and fitted[1] == messages[1] and fitted[-1] == messages[-1]
+
+def test_message_chain_forks_share_prefix():
+    base = MessageChain.from_messages([{"role": "system", "content": "system"}, {"role": "user", "content": "question"}])
+    fork_a = base.append({"role": "assistant", "content": "answer a"})
+    fork_b = base.append({"role": "assistant", "content": "answer b"})
+    assert fork_a.parent is base and fork_b.parent is base
+    assert len(base) == 2 and len(fork_a) == 3
+    assert fork_a[-1]["content"] == "answer a" and fork_b[-1]["content"] == "answer b"
+    assert fork_a.to_list()[:2] == base.to_list()
+
+def test_stream_parser_completes_on_disjoint_groups():
+    words = ["WAX", "MUMMY", "GIFT", "ANCHOR", "BURRITO", "PRESENT", "CLAY", "PAPYRUS", "SPRAIN", "FLAIR", "MODERATE", "TALENT", "INSTINCT", "PARCHMENT", "HOST", "FACULTY"]
+    parser = GroupStreamParser(words)
+    assert parser.feed("**WRITING SURFACES**: [WAX, CLAY, PAPYRUS, PARCHMENT]\n**GIVE**: [GIFT, PRES") == 1
+    content = "**WRITING SURFACES**: [WAX, CLAY, PAPYRUS, PARCHMENT]\n**GIVE**: [GIFT, PRESENT, HOST, MODERATE]\n"
+    assert parser.feed(content) == 1 and not parser.is_complete()
+    content += "**NOT ON BOARD**: [CAT, DOG, EMU, OWL]\n**KNACK**: [FLAIR, TALENT, INSTINCT, FACULTY]\n"
+    assert parser.feed(content) == 1 and not parser.is_complete()
+    content += "**WRAPPED**: [MUMMY, BURRITO, SPRAIN, ANCHOR]"
+    assert parser.feed(content) == 1 and parser.is_complete()
+
+def test_wordplay_detects_compound_group():
+    words = ["BONE", "LASH", "PACK", "STAGE", "WAX", "MUMMY", "GIFT", "ANCHOR", "PRESENT", "CLAY", "PAPYRUS", "SPRAIN", "FLAIR", "MODERATE", "TALENT", "INSTINCT"]
+    detector = WordplayDetector()
+    group_words, theme, confidence = detector.detect(words)[0]
+    assert sorted(group_words) == ["BONE", "LASH", "PACK", "STAGE"] and theme == "BACK + ___" and confidence == 1.0
+    assert [sorted(group[0]) for group in detector.confident_groups(words)] == [["BONE", "LASH", "PACK", "STAGE"]]
+    assert detector.detect(words, failed_groups=[["STAGE", "PACK", "LASH", "BONE"]]) == []
+
+def test_group_index_round_trip():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = GroupIndex(os.path.join(tmp_dir, 'group_index.db'))
+        index.record(["WAX", "CLAY", "PAPYRUS", "PARCHMENT"], True, "WRITING SURFACES")
+        index.record(["GIFT", "HOST", "FLAIR", "TALENT"], False)
+        index.record(["MUMMY", "BURRITO", "SPRAIN", "ANCHOR"], True)
+        known_correct, known_wrong = index.lookup(["WAX", "CLAY", "PAPYRUS", "PARCHMENT", "GIFT", "HOST", "FLAIR", "TALENT", "MUMMY"])
+        index.close()
+    assert known_correct == [{"WRITING SURFACES": ["CLAY", "PAPYRUS", "PARCHMENT", "WAX"]}]
+    assert known_wrong == [["FLAIR", "GIFT", "HOST", "TALENT"]]
+
+def test_board_memo_round_trip():
+    words = ["WAX", "MUMMY", "GIFT", "ANCHOR", "BURRITO", "PRESENT", "CLAY", "PAPYRUS", "SPRAIN", "FLAIR", "MODERATE", "TALENT", "INSTINCT", "PARCHMENT", "HOST", "FACULTY"]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        memo = BoardMemo(os.path.join(tmp_dir, 'board_memo.db'))
+        state_key = memo.state_key(words, [["GIFT", "HOST", "FLAIR", "TALENT"]], [])
+        assert state_key == memo.state_key(words[::-1], [["TALENT", "FLAIR", "HOST", "GIFT"]], [])
+        assert memo.lookup_ranking(state_key) is None
+        memo.record_ranking(state_key, [["CLAY", "PAPYRUS", "PARCHMENT", "WAX"]])
+        memo.record_outcome(words, ["WAX", "CLAY", "PAPYRUS", "PARCHMENT"], True)
+        memo.record_outcome(words, ["GIFT", "HOST", "FLAIR", "TALENT"], False)
+        ranking = memo.lookup_ranking(state_key)
+        outcomes = memo.lookup_outcomes(sorted(words))
+        memo.close()
+    assert ranking == [["CLAY", "PAPYRUS", "PARCHMENT", "WAX"]]
+    assert outcomes == ([["CLAY", "PAPYRUS", "PARCHMENT", "WAX"]], [["FLAIR", "GIFT", "HOST", "TALENT"]])
+
+def test_budget_degrades_and_raises():
+    budget = Budget(max_calls=4, max_tokens=1000)
+    assert (budget.ret_num_agents(3), budget.ret_num_rounds(2)) == (3, 2)
+    budget.charge(100)
+    budget.charge(100)
+    assert (budget.ret_num_agents(3), budget.ret_num_rounds(2)) == (2, 2)
+    budget.charge(100)
+    assert (budget.ret_num_agents(3), budget.ret_num_rounds(2)) == (2, 1)
+    budget.charge(100)
+    try:
+        budget.charge(100)
+        assert False, "the fifth call is over the limit"
+    except BudgetExceeded as e:
+        assert e.limit == 'calls'
+    assert budget.summary()["calls"] == 4 and budget.limit_hit == 'calls'
+
+    budget = Budget(max_tokens=500)
+    budget.charge(300)
+    budget.add_tokens(250)
+    try:
+        budget.charge(10)
+        assert False, "the token limit is spent"
+    except BudgetExceeded:
+        assert budget.limit_hit == 'tokens'
+
+def test_vote_tally_orders_by_votes_then_rank():
+    tally = VoteTally()
+    tally.add_solution({"1": ["WAX", "CLAY", "PAPYRUS", "PARCHMENT"], "2": ["GIFT", "PRESENT", "HOST", "MODERATE"]})
+    tally.add_solution({"1": ["GIFT", "PRESENT", "HOST", "MODERATE"], "2": ["CLAY", "WAX", "PARCHMENT", "PAPYRUS"]})
+    tally.add_solution({"1": ["FLAIR", "TALENT", "INSTINCT", "FACULTY"], "2": ["PAPYRUS", "PARCHMENT", "CLAY", "WAX"]})
+    assert tally.ranked_groups() == [["CLAY", "PAPYRUS", "PARCHMENT", "WAX"], ["GIFT", "HOST", "MODERATE", "PRESENT"], ["FACULTY", "FLAIR", "INSTINCT", "TALENT"]]
+    # a pipelined round submits a group once a majority of the agents voted for it
+    min_votes = 3 // 2 + 1
+    assert tally.agent_votes[("CLAY", "PAPYRUS", "PARCHMENT", "WAX")] >= min_votes
+    assert tally.agent_votes[("FACULTY", "FLAIR", "INSTINCT", "TALENT")] < min_votes
+
+def test_seeded_votes_are_not_agent_votes():
+    tally = VoteTally()
+    tally.add_group(["WAX", "CLAY", "PAPYRUS", "PARCHMENT"], rank=1, num_votes=2)
+    tally.add_solution({"1": ["GIFT", "PRESENT", "HOST", "MODERATE"], "2": ["CLAY", "WAX", "PARCHMENT", "PAPYRUS"]})
+    assert tally.ranked_groups()[0] == ["CLAY", "PAPYRUS", "PARCHMENT", "WAX"]
+    assert tally.agent_votes[("CLAY", "PAPYRUS", "PARCHMENT", "WAX")] == 1
+
+class StubDebater:
+    # stands in for a Debate that made num_calls calls and runs until it is cancelled
+    def __init__(self, num_calls):
+        self.num_agents = 3
+        self.num_rounds = 2
+        self.num_calls = num_calls
+        self.cancel_event = threading.Event()
+
+    def driver(self):
+        self.cancel_event.wait(5)
+        return []
+
+def test_speculator_charges_cancelled_calls():
+    words = ["WAX", "MUMMY", "GIFT", "ANCHOR", "BURRITO", "PRESENT", "CLAY", "PAPYRUS", "SPRAIN", "FLAIR", "MODERATE", "TALENT"]
+    speculator = Speculator(max_wasted_calls=13)
+    kept, cancelled = StubDebater(4), StubDebater(5)
+    speculator.start(words, [["GIFT", "PRESENT", "HOST", "MODERATE"]], kept)
+    speculator.start(words, [["WAX", "CLAY", "PAPYRUS", "PARCHMENT"]], cancelled)
+    speculator.resolve(words, [["MODERATE", "HOST", "PRESENT", "GIFT"]])
+    assert cancelled.cancel_event.is_set() and speculator.wasted_calls == 5
+    assert speculator.take(words, [["GIFT", "PRESENT", "HOST", "MODERATE"]]).debater is kept
+    # 9 calls of a full debate of 3 agents on top of the 5 wasted ones would go past 13
+    speculator.start(words, [], StubDebater(0))
+    assert speculator.branches == {}
+    kept.cancel_event.set()
+    speculator.close()
+
+def test_service_rejects_bad_bodies():
+    service = SolverService()
+    words = ["WAX", "MUMMY", "GIFT", "ANCHOR", "BURRITO", "PRESENT", "CLAY", "PAPYRUS", "SPRAIN", "FLAIR", "MODERATE", "TALENT", "INSTINCT", "PARCHMENT", "HOST", "FACULTY"]
+    for body in [[], {"words": "WAX"}, {"words": words[:15]}, {"words": words[:15] + ["wax"]}, {"words": words[:15] + [1]}]:
+        try:
+            asyncio.run(service.route('POST', '/sessions', body))
+            assert False, f"{body} is not a valid body"
+        except ServiceError as e:
+            assert e.status == 400
+    assert service.sessions == {}
+
+def test_router_escalates_and_counts_calls():
+    router = ModelRouter({"ranker": ["gpt-4o-mini", "gpt-4o"]})
+    assert router.model('ranker', 0) == "gpt-4o-mini" and router.model('ranker', 5) == "gpt-4o"
+    assert router.should_escalate('ranker', 0, True) and not router.should_escalate('ranker', 1, True)
+    assert not router.should_escalate('ranker', 0, False)
+    assert router.num_checks['ranker'] == 3 and router.num_escalations['ranker'] == 1
+    # calls are counted per request, not per model pick
+    model_name = router.model('debate')
+    for _ in range(3):
+        router.record_call('debate', model_name)
+    assert router.summary()["model_calls"] == {"debate/gpt-4o-mini": 3}
+
+    group_a, group_b = ["WAX", "CLAY", "PAPYRUS", "PARCHMENT"], ["GIFT", "PRESENT", "HOST", "MODERATE"]
+    solutions = [{"A": group_a, "B": group_b}, {"A": group_a[::-1], "B": ["GIFT", "PRESENT", "HOST", "FLAIR"]}, {"A": group_a, "C": ["FLAIR", "TALENT", "INSTINCT", "FACULTY"]}]
+    assert router.agreement(solutions) == 0.5
+    assert router.agreement([]) == 0.0
+
+class EchoBackend:
+    # batch backend that answers every request with its custom_id, or fails every batch
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.num_runs = 0
+
+    def run(self, input_path, output_path):
+        self.num_runs += 1
+        if self.fail:
+            raise IOError("batch upload failed")
+        with open(input_path) as f:
+            requests = [json.loads(line) for line in f]
+        return {request['custom_id']: {"choices": [{"message": {"content": request['custom_id']}}]} for request in requests}
+
+def test_batch_client_replays_cached_ids():
+    messages = [{"role": "user", "content": "question"}]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path, batch_dir = os.path.join(tmp_dir, 'cache.jsonl'), os.path.join(tmp_dir, 'batches')
+        backend = EchoBackend()
+        client = BatchClient(backend, cache_path, batch_dir, idle_seconds=0.05)
+        first = client.create('gpt-4o', messages).choices[0].message.content
+        second = client.create('gpt-4o', messages).choices[0].message.content
+        client.close()
+        assert first.endswith('-0') and second.endswith('-1') and first[:-2] == second[:-2]
+        assert backend.num_runs == 2
+
+        # a rerun asks for the same ids and is answered from the cache file
+        client = BatchClient(backend, cache_path, batch_dir, idle_seconds=0.05)
+        assert [client.create('gpt-4o', messages).choices[0].message.content for _ in range(2)] == [first, second]
+        client.close()
+        assert backend.num_runs == 2 and client.num_cached == 2
+
+def test_batch_client_fails_requests_of_a_lost_batch():
+    # the backend fails, or the batch file cannot even be written
+    for fail, batch_dir in [(True, 'batches'), (False, 'missing/batches')]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            client = BatchClient(EchoBackend(fail), os.path.join(tmp_dir, 'cache.jsonl'), os.path.join(tmp_dir, 'batches'), idle_seconds=0.05)
+            client.batch_dir = os.path.join(tmp_dir, batch_dir)
+            try:
+                client.create('gpt-4o', [{"role": "user", "content": "question"}])
+                assert False, "the batch was lost"
+            except OSError:
+                pass
+            client.close()
+
+class CountingClient:
+    # OpenAI client stand in that numbers its answers
+    def __init__(self):
+        self.num_calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, **kwargs):
+        self.num_calls += 1
+        body = {"choices": [{"message": {"content": f"answer {self.num_calls}"}}], "usage": {"prompt_tokens": 5, "completion_tokens": 2}}
+        response = to_response(body)
+        response.model_dump = lambda: body
+        return response
+
+def test_recording_replays_in_order():
+    messages = [{"role": "user", "content": "question"}]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'recording.jsonl')
+        recorder = RecordingClient(CountingClient(), path)
+        recorded = [recorder.chat.completions.create('gpt-4o', messages).choices[0].message.content for _ in range(2)]
+        replayer = ReplayClient(path, latency_scale=0)
+        replayed = [replayer.chat.completions.create('gpt-4o', messages).choices[0].message.content for _ in range(2)]
+        try:
+            replayer.chat.completions.create('gpt-4o', messages)
+            assert False, "only two answers were recorded"
+        except LookupError:
+            pass
+        try:
+            replayer.chat.completions.create('gpt-4o-mini', messages)
+            assert False, "a request to another model was not recorded"
+        except LookupError:
+            pass
+    assert recorded == replayed == ["answer 1", "answer 2"]
+
+def test_metrics_render_cumulative_buckets():
+    registry = MetricsRegistry()
+    calls = registry.register(Counter('llm_calls_total', 'LLM calls', ['stage']))
+    latency = registry.register(Histogram('llm_seconds', 'LLM latency', ['stage'], buckets=(1, 5)))
+    calls.inc('debate', amount=2)
+    for value in [0.5, 3, 10]:
+        latency.observe('debate', value=value)
+    assert registry.render().splitlines() == [
+        '# HELP llm_calls_total LLM calls', '# TYPE llm_calls_total counter', 'llm_calls_total{stage="debate"} 2',
+        '# HELP llm_seconds LLM latency', '# TYPE llm_seconds histogram',
+        'llm_seconds_bucket{stage="debate",le="1"} 1', 'llm_seconds_bucket{stage="debate",le="5"} 2', 'llm_seconds_bucket{stage="debate",le="+Inf"} 3',
+        'llm_seconds_sum{stage="debate"} 13.5', 'llm_seconds_count{stage="debate"} 3',
+    ]
+
 if __name__ == "__main__":
     #test_jury()
     test_debate()
\ No newline at end of file
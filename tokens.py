@@ -0,0 +1,228 @@
+'''
+Local token counting, per-component context budgets and a prompt size profiler
+'''
+from collections import defaultdict
+from functools import lru_cache
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# max prompt tokens per request, keyed by the component that owns the history
+DEFAULT_BUDGETS = {
+    'debate': 16000,
+    'extract': 4000,
+    'correction': 16000,
+    'ranker': 12000,
+    'jury': 4000,
+    'gpt': 8000,
+    'model': 16000,
+}
+
+MESSAGE_OVERHEAD = 3 # tokens added by the chat format for every message
+REPLY_OVERHEAD = 3 # every reply is primed with <|start|>assistant<|message|>
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding('o200k_base')
+    except Exception as e: # the encoding is downloaded on first use, which fails offline
+        print(f"Could not load a tiktoken encoding for {model_name} ({e!r}), estimating tokens from characters")
+        return None
+
+
+def count_tokens(text: str, model_name='gpt-4o'):
+    '''
+    Returns the number of tokens in text. Falls back to ~4 characters per token if tiktoken is not installed
+        or its encoding cannot be loaded
+    '''
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages, model_name='gpt-4o'):
+    '''
+    Returns the number of prompt tokens for a list of chat messages
+    '''
+    num_tokens = REPLY_OVERHEAD
+    for message in messages:
+        num_tokens += MESSAGE_OVERHEAD
+        for value in message.values():
+            num_tokens += count_tokens(str(value), model_name)
+    return num_tokens
+
+
+def shorten_text(text: str, max_tokens: int, model_name='gpt-4o'):
+    '''
+    Keeps the head and tail of text so that it fits in roughly max_tokens
+    '''
+    num_tokens = count_tokens(text, model_name)
+    if num_tokens <= max_tokens:
+        return text
+    keep_chars = max(int(len(text) * max_tokens / num_tokens) // 2, 1)
+    return f"{text[:keep_chars]}\n[...]\n{text[-keep_chars:]}"
+
+
+class ContextGuard:
+    '''
+    Fits outgoing requests into per-component token budgets. The history that is passed in is never modified,
+        a trimmed copy is returned instead
+    '''
+    def __init__(self, budgets=None):
+        self.budgets = dict(DEFAULT_BUDGETS)
+        if budgets:
+            self.budgets.update(budgets)
+
+    def num_pinned(self, messages):
+        # system prompts and the first question are always kept
+        num_pinned = 0
+        while num_pinned < len(messages) and messages[num_pinned]["role"] == "system":
+            num_pinned += 1
+        return min(num_pinned + 1, len(messages))
+
+    def drop_repeated(self, messages):
+        # keep only the latest copy of user messages that are repeated word for word (e.g. retry instructions)
+        seen = set()
+        kept = []
+        for message in reversed(messages):
+            if message["role"] == "user" and message["content"] in seen:
+                continue
+            seen.add(message["content"])
+            kept.append(message)
+        return kept[::-1]
+
+    def fit(self, messages, component: str, model_name='gpt-4o'):
+        '''
+        Returns (messages, num_tokens, num_trimmed) where messages fit in the token budget of the component.
+            Drops repeated instructions, then the oldest turns, then shortens the longest remaining messages
+        '''
+        messages = list(messages)
+        budget = self.budgets.get(component)
+        num_tokens = original_tokens = count_message_tokens(messages, model_name)
+        if budget is None or num_tokens <= budget:
+            return messages, num_tokens, 0
+
+        messages = self.drop_repeated(messages)
+        head = messages[:self.num_pinned(messages)]
+        tail = messages[len(head):]
+
+        # drop the oldest turns but always keep the latest message
+        num_dropped = 0
+        while len(tail) > 1 and count_message_tokens(head + tail, model_name) > budget:
+            tail = tail[1:]
+            num_dropped += 1
+        if num_dropped:
+            note = {"role": "user", "content": f"[{num_dropped} earlier messages were omitted to fit the context window]"}
+            head = head + [note]
+        messages = head + tail
+
+        # summarize the longest non system messages until the request fits
+        num_tokens = count_message_tokens(messages, model_name)
+        while num_tokens > budget:
+            candidates = [i for i in range(len(messages)) if messages[i]["role"] != "system"]
+            if not candidates:
+                break
+            longest = max(candidates, key=lambda i: len(messages[i]["content"]))
+            content = messages[longest]["content"]
+            target = max(count_tokens(content, model_name) - (num_tokens - budget), 1)
+            shortened = shorten_text(content, target, model_name)
+            if len(shortened) >= len(content):
+                break
+            messages[longest] = {**messages[longest], "content": shortened}
+            num_tokens = count_message_tokens(messages, model_name)
+
+        return messages, num_tokens, original_tokens - num_tokens
+
+
+class PromptProfiler:
+    '''
+    Records prompt tokens, completion tokens and call latency of every request by pipeline stage and component
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.prompt_tokens = defaultdict(int) # key: (stage, component)
+        self.num_calls = defaultdict(int)
+        self.trimmed_tokens = defaultdict(int)
+        self.completion_tokens = defaultdict(int)
+        self.call_seconds = defaultdict(float)
+        self.first_group_seconds = [] # seconds from the request to the first parsed group of each streamed answer
+        self.num_streams = 0
+        self.num_stopped_early = 0
+
+    def record(self, stage: str, component: str, num_tokens: int, trimmed_tokens=0):
+        key = (stage, component)
+        with self.lock:
+            self.prompt_tokens[key] += num_tokens
+            self.num_calls[key] += 1
+            self.trimmed_tokens[key] += trimmed_tokens
+
+    def record_response(self, stage: str, component: str, seconds: float, completion_tokens=0):
+        key = (stage, component)
+        with self.lock:
+            self.call_seconds[key] += seconds
+            self.completion_tokens[key] += completion_tokens
+
+    def record_stream(self, time_to_first_group, stopped_early: bool):
+        with self.lock:
+            self.num_streams += 1
+            self.num_stopped_early += int(stopped_early)
+            if time_to_first_group is not None:
+                self.first_group_seconds.append(time_to_first_group)
+
+    def summary(self):
+        '''
+        Returns a json serializable dict of the totals, of calls, tokens and seconds by stage and of the streamed answers
+        '''
+        with self.lock:
+            stages = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0})
+            for (stage, component), calls in self.num_calls.items():
+                key = (stage, component)
+                stages[stage]["calls"] += calls
+                stages[stage]["prompt_tokens"] += self.prompt_tokens[key]
+                stages[stage]["completion_tokens"] += self.completion_tokens[key]
+                stages[stage]["seconds"] += self.call_seconds[key]
+            streams = {
+                "count": self.num_streams,
+                "stopped_early": self.num_stopped_early,
+                "avg_time_to_first_group": sum(self.first_group_seconds) / len(self.first_group_seconds) if self.first_group_seconds else None,
+            }
+        return {
+            "calls": sum(stage["calls"] for stage in stages.values()),
+            "prompt_tokens": sum(stage["prompt_tokens"] for stage in stages.values()),
+            "completion_tokens": sum(stage["completion_tokens"] for stage in stages.values()),
+            "stages": dict(stages),
+            "streams": streams,
+        }
+
+    def report(self):
+        '''
+        Returns a table of prompt tokens by stage and component, largest first
+        '''
+        with self.lock:
+            items = sorted(self.prompt_tokens.items(), key=lambda x: -x[1])
+        total = max(sum(num_tokens for _, num_tokens in items), 1)
+        lines = [f"{'stage':<20}{'component':<12}{'calls':>7}{'tokens':>10}{'avg':>8}{'trimmed':>9}{'share':>8}"]
+        for key, num_tokens in items:
+            stage, component = key
+            calls = self.num_calls[key]
+            lines.append(f"{stage:<20}{component:<12}{calls:>7}{num_tokens:>10}{num_tokens // calls:>8}{self.trimmed_tokens[key]:>9}{num_tokens / total:>8.1%}")
+        lines.append(f"{'total':<32}{sum(self.num_calls.values()):>7}{total if items else 0:>10}")
+        return "\n".join(lines)
+
+
+context_guard = ContextGuard()
+profiler = PromptProfiler()
@@ -0,0 +1,142 @@
+'''
+Local detector for lexical groups (compounds, shared affixes, hidden words, anagrams) over every four word subset
+'''
+from collections import defaultdict
+import os
+import numpy as np
+from embeddings import ret_subset_idxs
+
+LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wordplay_lexicon.txt')
+MIN_HIDDEN_LENGTH = 4 # shorter hidden words (EAR, TEN, RED) are found inside too many ordinary words
+
+
+def load_lexicon(path=LEXICON_PATH):
+    '''
+    Returns (dict head -> set of tails where head+tail is a word, dict category -> set of words that can be hidden)
+    '''
+    compounds = defaultdict(set)
+    hidden_words = defaultdict(set)
+    section = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip().upper()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('['):
+                section = line.strip('[]')
+                continue
+            if section == 'COMPOUNDS':
+                head, tails = line.split(':')
+                compounds[head.strip()].update(tails.split())
+            elif section.startswith('HIDDEN '):
+                hidden_words[section[len('HIDDEN '):]].update(word for word in line.split() if len(word) >= MIN_HIDDEN_LENGTH)
+    return compounds, hidden_words
+
+
+class WordplayDetector:
+    '''
+    Precomputes wordplay features of every board word and stores them as bitmasks, so that every four word subset
+        can be checked for a shared feature in one vectorized pass. A feature shared by exactly four board words
+        is much stronger evidence than one shared by more, so confidence is scaled by 4 / number of holders
+    '''
+    # confidence of a feature shared by exactly four words
+    feature_weights = {'compound': 1.0, 'anagram': 1.0, 'affix': 0.9, 'short affix': 0.6, 'hidden': 0.8}
+
+    def __init__(self, lexicon_path=LEXICON_PATH, min_confidence=0.9, min_vote_confidence=0.6, k=5):
+        compounds, self.hidden_words = load_lexicon(lexicon_path)
+        self.tails_of = compounds # key: head, val: tails such that head+tail is a word
+        self.heads_of = defaultdict(set) # key: tail, val: heads such that head+tail is a word
+        for head, tails in compounds.items():
+            for tail in tails:
+                self.heads_of[tail].add(head)
+        self.min_confidence = min_confidence # groups above this can be submitted without an LLM call
+        self.min_vote_confidence = min_vote_confidence # groups above this are given to the debate and ranking
+        self.k = k
+
+    def word_features(self, word: str):
+        '''
+        Returns a dict with key: feature theme and val: feature type
+        '''
+        word = word.upper()
+        features = {}
+        for head in self.heads_of.get(word, ()):
+            features[f"{head} + ___"] = 'compound'
+        for tail in self.tails_of.get(word, ()):
+            features[f"___ + {tail}"] = 'compound'
+        for n in (3, 4, 5):
+            if len(word) > n:
+                affix_type = 'affix' if n >= 4 else 'short affix'
+                features[f"STARTS WITH {word[:n]}"] = affix_type
+                features[f"ENDS WITH {word[-n:]}"] = affix_type
+        features[f"ANAGRAMS OF {''.join(sorted(word))}"] = 'anagram'
+        for category, hidden_words in self.hidden_words.items():
+            if any(hidden in word and hidden != word for hidden in hidden_words):
+                features[f"HIDDEN {category}"] = 'hidden'
+        return features
+
+    def ret_feature_bitmasks(self, words: list[str]):
+        '''
+        Returns (list of feature themes, confidence of each feature, packed bitmasks of shape (len(words), num_bytes)).
+            Only features held by at least four words are kept
+        '''
+        word_features = [self.word_features(word) for word in words]
+        holders = defaultdict(list)
+        for i, features in enumerate(word_features):
+            for theme in features:
+                holders[theme].append(i)
+
+        themes = [theme for theme, idxs in holders.items() if len(idxs) >= 4]
+        has_feature = np.zeros((len(words), max(len(themes), 1)), dtype=bool)
+        confidence = np.zeros(max(len(themes), 1), dtype=np.float32)
+        for j, theme in enumerate(themes):
+            has_feature[holders[theme], j] = True
+            feature_type = word_features[holders[theme][0]][theme]
+            confidence[j] = self.feature_weights[feature_type] * 4 / len(holders[theme])
+        return themes, confidence, np.packbits(has_feature, axis=1)
+
+    def detect(self, words: list[str], failed_groups=()):
+        '''
+        Returns a list of (group words, theme, confidence) for the subsets that share a feature, most confident first.
+            Failed groups are skipped
+        '''
+        if len(words) < 4:
+            return []
+        themes, confidence, bitmasks = self.ret_feature_bitmasks(words)
+        if not themes:
+            return []
+
+        subset_idxs = ret_subset_idxs(len(words))
+        shared = bitmasks[subset_idxs[:, 0]] & bitmasks[subset_idxs[:, 1]] & bitmasks[subset_idxs[:, 2]] & bitmasks[subset_idxs[:, 3]]
+        shared = np.unpackbits(shared, axis=1, count=len(themes)).astype(bool)
+        feature_scores = np.where(shared, confidence[:len(themes)], 0)
+        best_feature = feature_scores.argmax(axis=1)
+        scores = feature_scores[np.arange(len(subset_idxs)), best_feature]
+
+        failed_keys = set(tuple(sorted(group)) for group in failed_groups)
+        groups = []
+        for idx in np.nonzero(scores > 0)[0][np.argsort(-scores[scores > 0], kind='stable')]:
+            group_words = [words[i] for i in subset_idxs[idx]]
+            if tuple(sorted(group_words)) not in failed_keys:
+                groups.append((group_words, themes[best_feature[idx]], float(scores[idx])))
+        return groups
+
+    def top_groups(self, words: list[str], failed_groups=(), k=None):
+        '''
+        Returns up to k lexical groups above min_vote_confidence as a list of (group words, theme, confidence)
+        '''
+        k = k or self.k
+        return [group for group in self.detect(words, failed_groups) if group[2] >= self.min_vote_confidence][:k]
+
+    def confident_groups(self, words: list[str], failed_groups=()):
+        '''
+        Returns the disjoint lexical groups above min_confidence that can be submitted without an LLM call
+        '''
+        used_words = set()
+        groups = []
+        for group_words, theme, score in self.detect(words, failed_groups):
+            if score < self.min_confidence:
+                break
+            if used_words.isdisjoint(group_words):
+                used_words.update(group_words)
+                groups.append((group_words, theme, score))
+        return groups